@@ -0,0 +1,85 @@
+"""
+Measures the memory allocated with each trace event using tracemalloc:
+the objects snoop creates for every trace callback, which become garbage
+straight away, and the events kept by the flight recorder.
+
+Usage:
+
+    python -m benchmarks.allocations
+"""
+
+import sys
+import tracemalloc
+
+import snoop
+from snoop.configuration import Config
+from snoop.formatting import CapturedEvent, Event
+from snoop.tracer import FrameInfo
+
+from .overhead import NullStream, loop
+
+
+def bytes_per_object(factory, number=10000):
+    """
+    Returns the average memory allocated by factory(),
+    keeping the results alive so that they're counted.
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objects = [factory() for _ in range(number)]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    # Don't count the list itself
+    return (after - before - sys.getsizeof(objects)) / float(number)
+
+
+def frame_info_factory():
+    frame = sys._getframe()
+    frame_info = FrameInfo(frame)
+    # Populates local_reprs, which is replaced on every event
+    frame_info.update_variables((), (), 'line', None)
+    return lambda: FrameInfo(frame), frame_info
+
+
+def local_reprs(frame_info):
+    frame_info.update_variables((), (), 'line', None)
+    return frame_info.local_reprs
+
+
+def recorder_bytes_per_event():
+    config = Config(out=NullStream(), color=False)
+    recorder = snoop.flight_recorder(size=100000, dump_signal=None, dump_on_exception=False, config=config)
+    traced = config.snoop(loop)
+    traced(1)  # Parse the source before measuring
+    try:
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            for _ in range(100):
+                traced(20)
+            after = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        events = sum(len(events) for events in recorder.threads.values())
+    finally:
+        recorder.stop()
+    return (after - before) / float(events)
+
+
+def main():
+    create_frame_info, frame_info = frame_info_factory()
+    results = [
+        ('Event', lambda: Event(frame_info, 'line', None, 0)),
+        ('CapturedEvent', lambda: CapturedEvent(Event(frame_info, 'line', None, 0))),
+        ('FrameInfo', create_frame_info),
+        ('local_reprs', lambda: local_reprs(frame_info)),
+    ]
+    for name, factory in results:
+        print('{:28} {:8.1f} bytes'.format(name, bytes_per_object(factory)))
+    print('{:28} {:8.1f} bytes'.format('flight recorder per event', recorder_bytes_per_event()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+"""
+Measures the overhead of tracing representative workloads,
+so that changes to Tracer.trace and DefaultFormatter.format can be compared.
+
+Usage:
+
+    python -m benchmarks.overhead [--json results.json] [--compare old.json] [names...]
+
+With --json, the results are also written as JSON, including the Python and snoop versions.
+With --compare, each result is shown relative to the same benchmark in a previous JSON file.
+Pass names (or parts of names) to only run some benchmarks.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+from collections import OrderedDict
+
+import snoop
+from snoop.configuration import Config, FileWriter
+
+benchmarks = OrderedDict()
+
+
+def benchmark(name):
+    def decorator(func):
+        benchmarks[name] = func
+        return func
+
+    return decorator
+
+
+class NullStream(object):
+    """
+    Stream which discards output, so that the stream writer's cost is measured
+    without the cost of a terminal.
+    """
+
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+
+def make_config(**kwargs):
+    kwargs.setdefault('out', NullStream())
+    kwargs.setdefault('color', False)
+    return Config(**kwargs)
+
+
+def loop(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+def make_loop(config=None, **kwargs):
+    if config is None:
+        return lambda: loop(20)
+    traced = config.snoop(**kwargs)(loop)
+    return lambda: traced(20)
+
+
+@benchmark('baseline')
+def baseline():
+    return make_loop()
+
+
+@benchmark('snoop')
+def snoop_default():
+    return make_loop(make_config())
+
+
+@benchmark('snoop_color')
+def snoop_color():
+    return make_loop(make_config(color=True))
+
+
+@benchmark('on_exception')
+def on_exception():
+    # Calls which don't raise are never formatted
+    return make_loop(make_config(), on_exception=True)
+
+
+@benchmark('only_if')
+def only_if():
+    return make_loop(make_config(), only_if='total < 0')
+
+
+@benchmark('flight_recorder')
+def flight_recorder():
+    config = make_config()
+    snoop.flight_recorder(size=1000, dump_signal=None, dump_on_exception=False, config=config)
+    return make_loop(config)
+
+
+def level3(x):
+    return x + 1
+
+
+def level2(x):
+    return level3(x) * 2
+
+
+def level1(x):
+    return level2(x) - 1
+
+
+@benchmark('depth_1')
+def depth_1():
+    traced = make_config().snoop(depth=1)(level1)
+    return lambda: traced(3)
+
+
+@benchmark('depth_3')
+def depth_3():
+    traced = make_config().snoop(depth=3)(level1)
+    return lambda: traced(3)
+
+
+def library(n):
+    # Stands in for a library with a deep call stack, which isn't traced
+    # but still causes a trace callback for every call
+    if n == 0:
+        return sum(library_helper(i) for i in range(3))
+    return library(n - 1) + library_helper(n)
+
+
+def library_helper(x):
+    return x + 1
+
+
+def make_library_caller(depth):
+    config = make_config()
+
+    @config.snoop(depth=depth)
+    def func():
+        return library(30)
+
+    return func
+
+
+@benchmark('deep_library_depth_1')
+def deep_library_depth_1():
+    return make_library_caller(1)
+
+
+@benchmark('deep_library_depth_3')
+def deep_library_depth_3():
+    return make_library_caller(3)
+
+
+@benchmark('deep_library_depth_10')
+def deep_library_depth_10():
+    return make_library_caller(10)
+
+
+@benchmark('watch_explode_dict')
+def watch_explode_dict():
+    config = make_config()
+
+    @config.snoop(watch_explode=['d'])
+    def func(d):
+        total = 0
+        for key in list(d)[:5]:
+            total += d[key]
+        return total
+
+    d = {'key{}'.format(i): i for i in range(1000)}
+    return lambda: func(d)
+
+
+@benchmark('comprehension')
+def comprehension():
+    config = make_config()
+
+    @config.snoop
+    def func(n):
+        squares = [i * i for i in range(n)]
+        evens = {i for i in squares if i % 2 == 0}
+        return len(evens)
+
+    return lambda: func(50)
+
+
+@benchmark('generator')
+def generator():
+    config = make_config()
+
+    @config.snoop
+    def gen(n):
+        for i in range(n):
+            yield i * 2
+
+    return lambda: sum(gen(10))
+
+
+@benchmark('pp')
+def pp():
+    config = make_config()
+    x = list(range(10))
+    y = {'a': 1, 'b': 2}
+    return lambda: config.pp(x, y, len(x))
+
+
+@benchmark('pp_deep')
+def pp_deep():
+    config = make_config()
+    x = 3
+    y = [1, 2, 3]
+    return lambda: config.pp.deep(lambda: x * 2 + sum(y) - len(y))
+
+
+@benchmark('stream_writer')
+def stream_writer():
+    # Compare to 'snoop' which writes to a stream that discards output
+    stream = io.StringIO()
+
+    def run():
+        stream.seek(0)
+        stream.truncate()
+        return traced()
+
+    traced = make_loop(make_config(out=stream))
+    return run
+
+
+@benchmark('file_writer')
+def file_writer():
+    return make_loop(make_config(out=temp_path()))
+
+
+@benchmark('file_writer_buffered')
+def file_writer_buffered():
+    # Equivalent to out=path, file_buffer_size=...,
+    # but the writer needs to be flushed before the file is deleted
+    writer = FileWriter(temp_path(), overwrite=False, buffer_size=1 << 16)
+    file_writers.append(writer)
+    return make_loop(make_config(out=writer.write))
+
+
+temp_paths = []
+file_writers = []
+
+
+def temp_path():
+    fd, path = tempfile.mkstemp(prefix='snoop_benchmark_')
+    os.close(fd)
+    temp_paths.append(path)
+    return path
+
+
+def measure(func, repeat):
+    """
+    Returns the fastest time per call in seconds,
+    calling func enough times per repetition to take at least 0.1 seconds.
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= 0.1:
+            break
+        number *= 2
+    times = [elapsed] + timer.repeat(repeat=repeat - 1, number=number)
+    return min(times) / number, number
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.overhead')
+    parser.add_argument('names', nargs='*', help='Only run benchmarks containing these strings')
+    parser.add_argument('--json', help='Write the results as JSON to this path')
+    parser.add_argument('--compare', help='JSON file from a previous run to compare with')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['benchmarks']
+
+    results = OrderedDict()
+    try:
+        for name, setup in benchmarks.items():
+            if args.names and not any(part in name for part in args.names):
+                continue
+            seconds, number = measure(setup(), args.repeat)
+            results[name] = dict(seconds=seconds, number=number, repeat=args.repeat)
+
+            line = '{:22} {:10.2f} us'.format(name, seconds * 1e6)
+            if 'baseline' in results and name != 'baseline':
+                line += '  {:8.1f}x baseline'.format(seconds / results['baseline']['seconds'])
+            if name in previous:
+                line += '  {:+7.1%} vs previous'.format(seconds / previous[name]['seconds'] - 1)
+            print(line)
+            sys.stdout.flush()
+    finally:
+        for writer in file_writers:
+            writer.flush()
+        for path in temp_paths:
+            os.remove(path)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(
+                python=sys.version,
+                implementation=platform.python_implementation(),
+                platform=platform.platform(),
+                snoop=snoop.__version__,
+                benchmarks=results,
+            ), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
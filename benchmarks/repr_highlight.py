@@ -0,0 +1,44 @@
+"""
+Compares highlighting variable reprs with ReprHighlighter's built-in tokenizer
+against pygments (without its lru_cache, since reprs rarely repeat).
+
+Usage:
+
+    python -m benchmarks.repr_highlight
+"""
+
+import timeit
+
+from snoop.formatting import NeutralMonokaiStyle, ReprHighlighter, raw_highlight
+from snoop.utils import my_cheap_repr
+
+
+class Foo(object):
+    pass
+
+
+values = [
+    ('int', 12345),
+    ('float', -0.125),
+    ('string', 'hello world'),
+    ('list', list(range(100))),
+    ('dict', {'alpha': 1.5, 'beta': None, 'gamma': [1, 2, 3]}),
+    ('object', Foo()),
+]
+
+
+def main():
+    highlighter = ReprHighlighter(NeutralMonokaiStyle)
+    for label, value in values:
+        code = my_cheap_repr(value)
+        assert highlighter(code) == raw_highlight(code, NeutralMonokaiStyle)
+
+        number = 1000
+        old = min(timeit.repeat(lambda: raw_highlight(code, NeutralMonokaiStyle), number=number, repeat=5))
+        new = min(timeit.repeat(lambda: highlighter(code), number=number, repeat=5))
+        print('{:7} {:4} chars: pygments {:8.2f} us, fast {:8.2f} us, speedup {:.1f}x'.format(
+            label, len(code), old / number * 1e6, new / number * 1e6, old / new))
+
+
+if __name__ == '__main__':
+    main()
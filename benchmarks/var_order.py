@@ -0,0 +1,49 @@
+"""
+Compares sorting local variables in FrameInfo.get_local_reprs
+using the cached per-code ranks against the previous approach,
+which rebuilt the variable order and sorted with tuple.index on every event.
+
+Usage:
+
+    python -m benchmarks.var_order
+"""
+
+import sys
+import timeit
+
+from snoop.tracer import FrameInfo
+
+
+def make_frame(num_locals):
+    source = 'def f():\n' + ''.join(
+        '    x{} = {}\n'.format(i, i)
+        for i in range(num_locals)
+    ) + '    return sys._getframe()\n'
+    namespace = {'sys': sys}
+    exec(source, namespace)
+    return namespace['f']()
+
+
+def old_sorted_var_names(frame):
+    code = frame.f_code
+    var_names = list(frame.f_locals)
+    vars_order = code.co_varnames + code.co_cellvars + code.co_freevars + tuple(var_names)
+    var_names.sort(key=vars_order.index)
+    return [(key, frame.f_locals[key]) for key in var_names]
+
+
+def main():
+    for num_locals in (10, 50, 200):
+        frame = make_frame(num_locals)
+        frame_info = FrameInfo(frame)
+        assert old_sorted_var_names(frame) == list(frame_info.get_local_reprs((), (), None))
+
+        number = 2000
+        old = min(timeit.repeat(lambda: old_sorted_var_names(frame), number=number, repeat=5))
+        new = min(timeit.repeat(lambda: list(frame_info.get_local_reprs((), (), None)), number=number, repeat=5))
+        print('{:4} locals: old {:8.2f} us, new {:8.2f} us, speedup {:.1f}x'.format(
+            num_locals, old / number * 1e6, new / number * 1e6, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,8 @@ import collections
 import sys
 
 from .configuration import Config, install
+from .recorder import flight_recorder
+from .utils import cache_stats, set_cache_limit
 from .variables import Attrs, Exploding, Indices, Keys
 
 __VersionInfo = collections.namedtuple('VersionInfo',
@@ -40,6 +42,9 @@ snoop = config.snoop
 pp = config.pp
 spy = config.spy
 install = staticmethod(install)
+flight_recorder = staticmethod(flight_recorder)
+cache_stats = staticmethod(cache_stats)
+set_cache_limit = staticmethod(set_cache_limit)
 
 sys.modules['snoop'] = snoop  # make the module callable
 
@@ -1,19 +1,28 @@
+import atexit
 import inspect
 import os
 import pprint
+import re
 import sys
 import threading
+import time
+import traceback
+import weakref
+from collections import deque
 from io import open
 
 import six
 
 import snoop as package
-from snoop.formatting import DefaultFormatter
+from snoop.formatting import DefaultFormatter, StructuredFormatter
 from snoop.pp_module import PP
+from snoop.profiling import OverheadProfiler
+from snoop.source_cache import source_cache
 from snoop.tracer import Spy, Tracer
 from snoop.utils import Mapping, QuerySet, Sequence, Set
 from snoop.utils import builtins as builtins_module
-from snoop.utils import ensure_tuple, is_pathlike, shitcode
+from snoop.utils import (IMMUTABLE, current_task, ensure_tuple, is_immutable,
+                         is_pathlike, shitcode, task_name)
 
 try:
     # Enable ANSI escape codes in Windows 10
@@ -41,6 +50,16 @@ def install(
         replace_watch_extras=None,
         formatter_class=DefaultFormatter,
         pformat=None,
+        monitoring=False,
+        async_write=False,
+        async_queue_size=1000,
+        async_overflow='block',
+        file_buffer_size=0,
+        file_flush_interval=1.0,
+        repr_fingerprint=None,
+        source_cache_dir=None,
+        profile_overhead=False,
+        demux=False,
 ):
     """
     Configure output, enable or disable, and add names to builtins. Parameters:
@@ -60,15 +79,26 @@ def install(
     - `prefix`: Pass a string to start all snoop lines with that string so you can grep for them easily.
     - `columns`: This specifies the columns at the start of each output line. You can pass a string with the names of built in columns separated by spaces or commas. These are the available columns:
         - `time`: The current time. This is the only column by default.
+        - `elapsed`: The number of seconds since the first line with this column was written, measured with a monotonic clock. This is faster to compute than `time`.
         - `thread`: The name of the current thread.
         - `thread_ident`: The [identifier](https://docs.python.org/3/library/threading.html#threading.Thread.ident) of the current thread, in case thread names are not unique.
+        - `task`: The name of the current asyncio task, if any.
         - `file`: The filename (not the full path) of the current function.
         - `full_file`: The full path to the file (also shown anyway when the function is called).
         - `function`: The name of the current function.
         - `function_qualname`: The qualified name of the current function.
 
-        If you want a custom column, please open an issue to tell me what you're interested in! In the meantime, you can pass a list, where the elements are either strings or callables. The callables should take one argument, which will be an `Event` object. It has attributes `frame`, `event`, and `arg`, as specified in [`sys.settrace()`](https://docs.python.org/3/library/sys.html#sys.settrace), and other attributes which may change.
+        If you want a custom column, please open an issue to tell me what you're interested in! In the meantime, you can pass a list, where the elements are either strings or callables. The callables should take one argument, which will be an `Event` object. It has attributes `frame`, `event`, and `arg`, as specified in [`sys.settrace()`](https://docs.python.org/3/library/sys.html#sys.settrace), and other attributes which may change. `frame` and `arg` are `None` for events which are formatted after they happened, i.e. with `only_if`, `on_exception`, or the flight recorder.
     - `pformat`: set the pretty formatting function `pp` uses. Default is to use the first of `prettyprinter.pformat`, `pprintpp.pformat` and `pprint.pformat` that can be imported.
+    - `monitoring`: set to True to trace using [`sys.monitoring`](https://docs.python.org/3/library/sys.monitoring.html) instead of `sys.settrace` in Python 3.12+. Only the traced functions (and their callees within `depth`) generate events, so other code runs at full speed while a function is being snooped. The output is the same. Falls back to `sys.settrace` in older versions of Python or if another tool is already using `sys.monitoring`.
+    - `async_write`: set to True to write output in a background thread so that the traced program doesn't wait for the terminal or file. Output is queued and written in batches, and any remaining output is written when the interpreter exits.
+        - `async_queue_size`: the maximum number of pending writes in the queue.
+        - `async_overflow`: what to do when the queue is full. `'block'` (the default) waits for space in the queue, `'drop_oldest'` discards the oldest pending write, and `'drop_newest'` discards the new write. When output is discarded, a line saying how many writes were dropped is written at the start of the next batch of output. Only `'block'` can be used with `StructuredFormatter`.
+    - `file_buffer_size`: when `out` is a path, by default the file is opened and closed for every write so that it can be inspected or moved freely. Pass a number of characters to instead keep the file open and buffer output until that much is pending, or until `file_flush_interval` seconds have passed since the last flush when something is written. The buffer is also flushed when the interpreter exits. If the file is moved or deleted (e.g. by log rotation) it's reopened at the original path.
+    - `repr_fingerprint`: a function used to avoid recomputing the repr of a variable at every line when it hasn't changed. It takes a value and returns a fingerprint, and if the same object has the same fingerprint on the next line, the previous repr is reused. Returning `None` means the repr is always recomputed. The default, `immutable_fingerprint`, only reuses reprs of objects which can't change, like ints, strings and tuples of those. `length_fingerprint` also assumes that lists, dicts, and sets haven't changed if their length is the same, which is faster but may display stale values. Both can be imported from `snoop.configuration`.
+    - `source_cache_dir`: a directory in which to store the syntax highlighted source code of traced files, so that other processes (e.g. short-lived workers) don't need to highlight the same large files again. An entry is only used if the file's contents haven't changed. This setting applies to the whole process, not just this configuration.
+    - `profile_overhead`: set to True to measure how much time snoop itself spends on different tasks: trace callbacks in general (including those for frames which aren't traced), parsing source files, collecting variables, computing reprs, formatting, and writing output. A report is written to the output when the interpreter exits, or you can get it at any time as a string from `config.profiler.report()`, where `config` is a `Config` object or `snoop.config` when using `install()`. `config.profiler.reset()` starts the measurements again.
+    - `demux`: set to True to keep the output of each thread and asyncio task separate when they're traced at the same time. Output is buffered until the outermost traced call in the thread or task ends (including across `await`s), and then written in one piece, so lines from concurrent calls don't interleave. Output from `pp` outside of traced calls is written immediately. If `out` is a path containing `{thread}` or `{task}`, these are replaced by the names of the thread and task (empty outside of tasks) so that each one writes to its own file, e.g. `out='snoop-{thread}.log'`. Each file is closed once its thread or task has finished. This can't be combined with `async_write` or `StructuredFormatter`.
     """
 
     if builtins:
@@ -86,6 +116,16 @@ def install(
         replace_watch_extras=replace_watch_extras,
         formatter_class=formatter_class,
         pformat=pformat,
+        monitoring=monitoring,
+        async_write=async_write,
+        async_queue_size=async_queue_size,
+        async_overflow=async_overflow,
+        file_buffer_size=file_buffer_size,
+        file_flush_interval=file_flush_interval,
+        repr_fingerprint=repr_fingerprint,
+        source_cache_dir=source_cache_dir,
+        profile_overhead=profile_overhead,
+        demux=demux,
     )
     package.snoop.config = config
     package.pp.config = config
@@ -111,6 +151,16 @@ class Config(object):
             replace_watch_extras=None,
             formatter_class=DefaultFormatter,
             pformat=None,
+            monitoring=False,
+            async_write=False,
+            async_queue_size=1000,
+            async_overflow='block',
+            file_buffer_size=0,
+            file_flush_interval=1.0,
+            repr_fingerprint=None,
+            source_cache_dir=None,
+            profile_overhead=False,
+            demux=False,
     ):
         if can_color:
             if color is None:
@@ -119,9 +169,47 @@ class Config(object):
         else:
             color = False
 
-        self.write = get_write_function(out, overwrite)
+        if issubclass(formatter_class, StructuredFormatter):
+            # Each file and code object is only described by the first record
+            # that refers to it, so no records can be dropped or reordered
+            if demux:
+                raise ValueError("demux can't be used with StructuredFormatter")
+            if async_write and async_overflow != 'block':
+                raise ValueError("StructuredFormatter requires async_overflow='block'")
+
+        self.thread_local = threading.local()
+
+        if demux and isinstance(out, six.string_types) and ('{thread}' in out or '{task}' in out):
+            if async_write:
+                raise ValueError("async_write can't be used with a separate file for each thread or task")
+
+            def get_file_writer(thread_name, task_name):
+                path = out.format(
+                    thread=safe_filename(thread_name),
+                    task=safe_filename(task_name or u''),
+                )
+                # Flushed by the DemuxWriter instead of registering atexit for each file
+                return FileWriter(path, overwrite, file_buffer_size, file_flush_interval,
+                                  register_atexit=False)
+
+            self.demux = DemuxWriter(self.thread_local, get_file_writer=get_file_writer)
+        else:
+            self.write = get_write_function(out, overwrite, file_buffer_size, file_flush_interval)
+            if async_write:
+                # e.g. a FileWriter, whose own atexit handler may run before the queue is drained
+                output = getattr(self.write, '__self__', None)
+                self.async_writer = AsyncWriter(self.write, async_queue_size, async_overflow,
+                                                flush=getattr(output, 'flush', None))
+                self.write = self.async_writer.write
+            self.demux = None
+            if demux:
+                self.demux = DemuxWriter(self.thread_local, write=self.write)
+
+        if self.demux:
+            self.write = self.demux.write
         self.formatter = formatter_class(prefix, columns, color)
         self.enabled = enabled
+        self.monitoring = monitoring
 
         if pformat is None:
             try:
@@ -133,6 +221,16 @@ class Config(object):
                     from pprint import pformat
 
         self.pformat = pformat
+        self.repr_fingerprint = repr_fingerprint or immutable_fingerprint
+        if source_cache_dir is not None:
+            source_cache.directory = six.text_type(source_cache_dir)
+
+        # Set by snoop.flight_recorder()
+        self.recorder = None
+
+        self.profiler = None
+        if profile_overhead:
+            self._enable_profiling()
 
         self.pp = PP(self)
 
@@ -142,14 +240,39 @@ class Config(object):
         self.snoop = ConfiguredTracer
         self.spy = Spy(self)
 
-        self.last_frame = None
-        self.thread_local = threading.local()
-
         if replace_watch_extras is not None:
             self.watch_extras = ensure_tuple(replace_watch_extras)
         else:
             self.watch_extras = (len_shape_watch, dtype_watch) + ensure_tuple(watch_extras)
 
+    @property
+    def last_frame(self):
+        # The frame of the last event traced in the current thread
+        return getattr(self.thread_local, 'last_frame', None)
+
+    @last_frame.setter
+    def last_frame(self, frame):
+        self.thread_local.last_frame = frame
+
+    def _enable_profiling(self):
+        self.profiler = profiler = OverheadProfiler()
+        write = self.write
+        self.write = profiler.wrap('write', write)
+        for name in [
+            'format',
+            'format_line_only',
+            'format_log',
+            'format_log_value',
+            'format_loop_summary',
+            'format_suppressed',
+        ]:
+            method = getattr(self.formatter, name, None)
+            if method is not None:
+                setattr(self.formatter, name, profiler.wrap('format', method))
+
+        # Using the unwrapped write so the report isn't included in itself
+        atexit.register(lambda: write(profiler.report()))
+
 
 def len_shape_watch(source, value):
     try:
@@ -182,13 +305,26 @@ def dtype_watch(source, value):
         return '{}.dtype'.format(source), dtype
 
 
-def get_write_function(output, overwrite):
+def immutable_fingerprint(value):
+    if is_immutable(value):
+        return IMMUTABLE
+    return None
+
+
+def length_fingerprint(value):
+    result = immutable_fingerprint(value)
+    if result is None and type(value) in (list, dict, set, bytearray, deque):
+        result = len(value)
+    return result
+
+
+def get_write_function(output, overwrite, file_buffer_size=0, file_flush_interval=1.0):
     is_path = (
         isinstance(output, six.string_types)
         or is_pathlike(output)
     )
     if is_path:
-        return FileWriter(output, overwrite).write
+        return FileWriter(output, overwrite, file_buffer_size, file_flush_interval).write
     elif callable(output):
         write = output
     else:
@@ -209,12 +345,267 @@ def get_write_function(output, overwrite):
     return write
 
 
+def safe_filename(name):
+    return re.sub(r'[^\w.-]', '_', name)
+
+
 class FileWriter(object):
-    def __init__(self, path, overwrite):
+    def __init__(self, path, overwrite, buffer_size=0, flush_interval=1.0, register_atexit=True):
         self.path = six.text_type(path)
         self.overwrite = overwrite
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.buffered_length = 0
+        self.last_flush = time.time()
+        self.file = None
+        self.file_id = None
+        self.lock = threading.Lock()
+        if buffer_size and register_atexit:
+            atexit.register(self.flush)
+
+    def write(self, s):
+        if not self.buffer_size:
+            with open(self.path, 'w' if self.overwrite else 'a', encoding='utf-8') as f:
+                f.write(s)
+            self.overwrite = False
+            return
+
+        with self.lock:
+            self.buffer.append(s)
+            self.buffered_length += len(s)
+            if (
+                    self.buffered_length >= self.buffer_size
+                    or time.time() - self.last_flush >= self.flush_interval
+            ):
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _flush(self):
+        self.last_flush = time.time()
+        if not self.buffer:
+            return
+        data = u''.join(self.buffer)
+        del self.buffer[:]
+        self.buffered_length = 0
+        f = self._get_file()
+        f.write(data)
+        f.flush()
+
+    def _get_file(self):
+        if self.file is not None:
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                stat = None
+            if stat is None or (stat.st_dev, stat.st_ino) != self.file_id:
+                # The file has been rotated or deleted
+                self.file.close()
+                self.file = None
+
+        if self.file is None:
+            self.file = open(self.path, 'w' if self.overwrite else 'a', encoding='utf-8')
+            self.overwrite = False
+            stat = os.fstat(self.file.fileno())
+            self.file_id = (stat.st_dev, stat.st_ino)
+
+        return self.file
+
+
+# Open instances of AsyncWriter, closed by one atexit handler
+async_writers = weakref.WeakSet()
+
+
+@atexit.register
+def close_async_writers():
+    for writer in list(async_writers):
+        writer.close()
+
+
+class AsyncWriter(object):
+    """
+    Passes output to a write function in a background thread.
+    Pending writes are joined together and written in batches.
+    If given, `flush` is called after the remaining output is written by close().
+    """
+
+    overflow_policies = ('block', 'drop_oldest', 'drop_newest')
+
+    def __init__(self, write, max_size, overflow, flush=None):
+        if overflow not in self.overflow_policies:
+            raise ValueError("async_overflow must be one of {}".format(self.overflow_policies))
+        assert max_size >= 1
+
+        self._write = write
+        self._flush_output = flush
+        self.max_size = max_size
+        self.overflow = overflow
+        self.pending = deque()
+        self.dropped = 0
+        self.writing = False
+        self.closed = False
+        self.thread = None
+        self.condition = threading.Condition()
+        async_writers.add(self)
+
+    def write(self, s):
+        with self.condition:
+            if self.closed:
+                # The interpreter is shutting down
+                self._write(s)
+                if self._flush_output:
+                    self._flush_output()
+                return
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='snoop-writer')
+                self.thread.daemon = True
+                self.thread.start()
+
+            if len(self.pending) >= self.max_size:
+                if self.overflow == 'block':
+                    while len(self.pending) >= self.max_size:
+                        self.condition.wait()
+                elif self.overflow == 'drop_oldest':
+                    self.pending.popleft()
+                    self.dropped += 1
+                else:
+                    self.dropped += 1
+                    return
+
+            self.pending.append(s)
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not (self.pending or self.closed):
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                batch = list(self.pending)
+                self.pending.clear()
+                if self.dropped:
+                    batch.insert(0, u'[snoop] {} writes dropped because the output queue was full\n'
+                                 .format(self.dropped))
+                    self.dropped = 0
+                self.writing = True
+                self.condition.notify_all()
+
+            try:
+                self._write(u''.join(batch))
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
+
+    def flush(self):
+        """
+        Waits until all pending output has been written.
+        """
+        with self.condition:
+            while self.pending or self.writing:
+                self.condition.wait()
+
+    def close(self):
+        async_writers.discard(self)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        if self._flush_output:
+            self._flush_output()
+
+
+class DemuxWriter(object):
+    """
+    Keeps the output of each thread and asyncio task separate.
+    Output is buffered until Tracer calls end_block when the outermost
+    traced call in the thread or task ends, and then written in one piece.
+    Either all output goes to `write`, or `get_file_writer(thread_name, task_name)`
+    returns a FileWriter for each thread and task.
+    FileWriters of threads and tasks that have finished are closed in end_block.
+    """
+
+    def __init__(self, thread_local, write=None, get_file_writer=None):
+        self.thread_local = thread_local
+        self._write = write
+        self.get_file_writer = get_file_writer
+        # Maps (thread name, task name) to (FileWriter, thread, task)
+        self.file_writers = {}
+        self.buffers = {}
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    @staticmethod
+    def current_key():
+        return threading.current_thread(), current_task()
+
+    def output(self, key):
+        if self.get_file_writer is None:
+            return self._write
+
+        thread, task = key
+        names = (thread.name, task and task_name(task))
+        with self.lock:
+            entry = self.file_writers.get(names)
+            if entry is None:
+                entry = self.file_writers[names] = (self.get_file_writer(*names), thread, task)
+        return entry[0].write
 
     def write(self, s):
-        with open(self.path, 'w' if self.overwrite else 'a', encoding='utf-8') as f:
-            f.write(s)
-        self.overwrite = False
+        key = self.current_key()
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            if getattr(self.thread_local, 'depth', -1) < 0:
+                # Not in a traced call, e.g. pp
+                self.output(key)(s)
+                return
+            buffer = self.buffers[key] = []
+        buffer.append(s)
+
+    def end_block(self):
+        key = self.current_key()
+        buffer = self.buffers.pop(key, None)
+        if buffer:
+            self.output(key)(u''.join(buffer))
+        if self.file_writers:
+            self.close_finished()
+
+    def close_finished(self):
+        with self.lock:
+            finished = [
+                names
+                for names, (_, thread, task) in self.file_writers.items()
+                if (task.done() if task is not None else not thread.is_alive())
+            ]
+            file_writers = [self.file_writers.pop(names)[0] for names in finished]
+        for file_writer in file_writers:
+            file_writer.close()
+
+    def flush(self):
+        """
+        Writes the output of calls which haven't finished,
+        e.g. in daemon threads when the interpreter exits.
+        """
+        for key in list(self.buffers):
+            buffer = self.buffers.pop(key, None)
+            if buffer:
+                self.output(key)(u''.join(buffer))
+        with self.lock:
+            file_writers = [entry[0] for entry in self.file_writers.values()]
+        for file_writer in file_writers:
+            file_writer.flush()
@@ -0,0 +1,105 @@
+"""
+Tracing of coroutines and async generators, used by Tracer.__call__.
+This module uses async syntax, so it's only imported in Python 3.5+.
+
+As with generators, the tracer is only active while the coroutine is running.
+While it's suspended in an await, other tasks on the event loop run without being traced.
+"""
+
+import functools
+
+from snoop.utils import isasyncgenfunction
+
+
+class TracedCoroutine(object):
+    """
+    Wraps a coroutine, or an awaitable from an async generator,
+    and runs each step of it with the tracer active,
+    like generator_wrapper in Tracer.__call__.
+    """
+
+    def __init__(self, tracer, coroutine):
+        self.tracer = tracer
+        self.coroutine = coroutine
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def send(self, value):
+        with self.tracer:
+            return self.coroutine.send(value)
+
+    def throw(self, *args):
+        with self.tracer:
+            return self.coroutine.throw(*args)
+
+    def close(self):
+        return self.coroutine.close()
+
+
+class TracedAsyncGenerator(object):
+    """
+    Wraps an async generator so that each step of it is traced by a TracedCoroutine.
+    """
+
+    def __init__(self, tracer, async_generator):
+        self.tracer = tracer
+        self.async_generator = async_generator
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return TracedCoroutine(self.tracer, self.async_generator.__anext__())
+
+    def asend(self, value):
+        return TracedCoroutine(self.tracer, self.async_generator.asend(value))
+
+    def athrow(self, *args):
+        return TracedCoroutine(self.tracer, self.async_generator.athrow(*args))
+
+    def aclose(self):
+        return TracedCoroutine(self.tracer, self.async_generator.aclose())
+
+
+def async_wrapper(tracer, function):
+    """
+    Returns a wrapper which traces calls to a coroutine function
+    or async generator function, respecting the tracer's sampling options.
+    """
+    if tracer.sampling:
+        from snoop.tracer import CallSampler
+        should_trace = CallSampler(tracer)
+    else:
+        def should_trace():
+            return True
+
+    if isasyncgenfunction(function):
+        # A plain function rather than an async generator function,
+        # since async generators don't exist in Python 3.5 where this module is also used.
+        # So inspect.isasyncgenfunction(async_generator_wrapper) is False, see the README.
+        @functools.wraps(function)
+        def async_generator_wrapper(*args, **kwargs):
+            async_generator = function(*args, **kwargs)
+            if not should_trace():
+                return async_generator
+            return TracedAsyncGenerator(tracer, async_generator)
+
+        return async_generator_wrapper
+
+    # A coroutine function rather than a function returning an awaitable,
+    # so that frameworks which check with inspect.iscoroutinefunction await it
+    @functools.wraps(function)
+    async def coroutine_wrapper(*args, **kwargs):
+        coroutine = function(*args, **kwargs)
+        if not should_trace():
+            return await coroutine
+        return await TracedCoroutine(tracer, coroutine)
+
+    return coroutine_wrapper
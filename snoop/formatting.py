@@ -1,6 +1,11 @@
 import ast
+import json
+import re
+import sys
 import threading
+import time
 import traceback
+from bisect import bisect_right
 from collections import defaultdict
 from datetime import datetime
 from textwrap import dedent
@@ -12,11 +17,15 @@ from pygments import highlight
 from pygments.formatters.terminal256 import Terminal256Formatter
 from pygments.lexers.python import Python3Lexer
 from pygments.styles.monokai import MonokaiStyle
+from pygments.token import Token
 from six import PY3
 
+from snoop.source_cache import source_cache
 from snoop.utils import (NO_ASTTOKENS, ArgDefaultDict, FormattedValue,
-                         ensure_tuple, lru_cache, my_cheap_repr,
-                         optional_numeric_label, short_filename, try_statement)
+                         LRUCache, current_task_name, ensure_tuple, lru_cache,
+                         lru_cached_functions, my_cheap_repr,
+                         optional_numeric_label, short_filename, try_statement,
+                         unwrap_async_gen_value)
 
 try:
     from pygments.lexers.python import Python2Lexer
@@ -24,6 +33,9 @@ except ImportError:
     from pygments.lexers.python import PythonLexer as Python2Lexer
 
 
+loop_statements = (ast.For, ast.While) + ((ast.AsyncFor,) if hasattr(ast, 'AsyncFor') else ())
+
+
 class StatementsDict(dict):
     def __init__(self, source):
         super(StatementsDict, self).__init__()
@@ -42,22 +54,51 @@ class StatementsDict(dict):
 class Source(executing.Source):
     def __init__(self, *args, **kwargs):
         super(Source, self).__init__(*args, **kwargs)
+        self.cache_entry = None
         if self.tree and self.text:
-            self.highlighted = ArgDefaultDict(
-                lambda style: raw_highlight(self.text, style).splitlines()
-            )
+            self.highlighted = ArgDefaultDict(self.get_highlighted)
         else:
             self.lines = defaultdict(lambda: u'SOURCE IS UNAVAILABLE')
             self.highlighted = defaultdict(lambda: self.lines)
         self.statements = StatementsDict(self)
-        self.nodes = []
-        if self.tree:
-            self.tree._depth = 0
-            for node in ast.walk(self.tree):
-                node._tree_index = len(self.nodes)
-                self.nodes.append(node)
-                for child in ast.iter_child_nodes(node):
-                    child._depth = node._depth + 1
+        self.loops = ArgDefaultDict(self.loop_at_line)
+        self._nodes = None
+
+    def loop_at_line(self, line_no):
+        """
+        Returns the for/while loop whose header starts at the given line, or None.
+        The line may also hold statements of the body, as in `for x in y: f(x)`,
+        so the statements on the line are searched along with their ancestors.
+        """
+        for statement in self.statements_at_line(line_no):
+            node = statement
+            while node is not None:
+                if isinstance(node, loop_statements) and node.lineno == line_no:
+                    return node
+                node = getattr(node, 'parent', None)
+        return None
+
+    def get_highlighted(self, style):
+        if source_cache.directory:
+            # Highlighting the whole file once is worth it if it's saved for other processes
+            return source_cache.highlighted_lines(self, style, raw_highlight)
+        return HighlightedLines(self, style)
+
+    @property
+    def nodes(self):
+        # Only needed by pp.deep, so computed on demand
+        # rather than slowing down the first trace of every file
+        if self._nodes is None:
+            nodes = []
+            if self.tree:
+                self.tree._depth = 0
+                for node in ast.walk(self.tree):
+                    node._tree_index = len(nodes)
+                    nodes.append(node)
+                    for child in ast.iter_child_nodes(node):
+                        child._depth = node._depth + 1
+            self._nodes = nodes
+        return self._nodes
 
     def get_text_with_indentation(self, node):
         result = self.asttokens().get_text(node)
@@ -85,6 +126,72 @@ class Source(executing.Source):
         return result
 
 
+# executing keeps a Source for every version of every file it's asked about,
+# and the node being executed for each instruction it's asked about,
+# in these class attributes. Replace them with caches which evict old entries.
+# '__source_cache' is the name in older versions of executing.
+_source_cache = LRUCache('sources')
+setattr(Source, '__source_cache_with_lines', _source_cache)
+setattr(Source, '__source_cache', _source_cache)
+setattr(Source, '__executing_cache', LRUCache('executing'))
+
+
+class HighlightedLines(object):
+    """
+    Sequence of the syntax highlighted lines of a source file.
+    Lines are highlighted on demand, a chunk at a time, so that tracing a function
+    in a large file doesn't mean highlighting the whole file.
+    Chunks start at the beginning of a statement, so they always consist of complete
+    tokens, and multiline strings and brackets are highlighted correctly.
+    """
+
+    def __init__(self, source, style):
+        self.source = source
+        self.style = style
+        self.highlighted = {}
+        self.text_lines = None
+        self.chunk_starts = None
+
+    def __len__(self):
+        return len(self.source.lines)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        try:
+            return self.highlighted[index]
+        except KeyError:
+            pass
+
+        if self.text_lines is None:
+            self.text_lines = self.source.text.splitlines(True)
+            self.chunk_starts = sorted({0} | {
+                node.lineno - 1
+                for node in ast.walk(self.source.tree)
+                if isinstance(node, ast.stmt)
+            })
+
+        lines = self.text_lines
+        if not 0 <= index < len(lines):
+            raise IndexError(index)
+
+        starts = self.chunk_starts
+        i = bisect_right(starts, index) - 1
+        start = starts[i]
+        end = starts[i + 1] if i + 1 < len(starts) else len(lines)
+        chunk = raw_highlight(u''.join(lines[start:end]), self.style).splitlines()
+        if len(chunk) != end - start:
+            # Unusual line breaks such as form feeds, just highlight everything
+            start = 0
+            chunk = raw_highlight(self.source.text, self.style).splitlines()
+
+        for offset, line in enumerate(chunk):
+            self.highlighted[start + offset] = line
+        return self.highlighted[index]
+
+
+monotonic = getattr(time, 'monotonic', time.time)
+
 lexer = (Python3Lexer if PY3 else Python2Lexer)(stripnl=False)
 
 
@@ -108,17 +215,200 @@ class NeutralMonokaiStyle(MonokaiStyle):
     }
 
 
-formatters = ArgDefaultDict(lambda style: ForceWhiteTerminal256Formatter(style=style))
+formatters = LRUCache('formatters', lambda style: ForceWhiteTerminal256Formatter(style=style))
 
 
 def raw_highlight(code, style):
     return highlight(code, lexer, formatters[style])
 
 
-cached_highlight = lru_cache(maxsize=1024)(raw_highlight)
+cached_highlight = lru_cached_functions['highlight'] = lru_cache(maxsize=1024)(raw_highlight)
+
+
+class ReprHighlighter(object):
+    """
+    Highlights common reprs like those produced by cheap_repr (numbers, simple strings,
+    names, brackets, and ellipses) much faster than pygments, with the same result.
+    Anything else, e.g. strings containing escapes or multiline values,
+    is passed to pygments.
+
+    The tokens are formatted with the same escape codes as the pygments formatter.
+    In case a version of pygments tokenizes differently, the results for some samples are
+    compared with pygments the first time it's used, and if any differ, pygments is always used.
+    """
+
+    token_pattern = re.compile(r"""
+        (?P<space>\ )(?=\S)
+        |(?P<hex>0x[0-9a-fA-F]+)(?![\w.])
+        |(?P<float>[0-9]+\.[0-9]+)(?![\w.])
+        |(?P<integer>[0-9]+)(?![\w.])
+        |(?P<name>[A-Za-z_][A-Za-z0-9_]*)(?![\w'"])
+        |(?P<single>')(?P<single_body>[^\\'"%{}\n]*)(?P<single_end>')
+        |(?P<double>")(?P<double_body>[^\\'"%{}\n]*)(?P<double_end>")
+        |(?P<punctuation>[][(){},]|:(?!=))
+        |(?P<operator>\.(?![0-9])|[-<>=](?![-<>=]))
+    """, re.VERBOSE)
+    # A '.' before a digit starts a float and ':=' is one operator in pygments,
+    # so they don't match any group and the code is passed to pygments
+
+    group_token_types = {
+        'space': Token.Text,
+        'hex': Token.Literal.Number.Hex,
+        'float': Token.Literal.Number.Float,
+        'integer': Token.Literal.Number.Integer,
+        'single': Token.Literal.String.Single,
+        'single_body': Token.Literal.String.Single,
+        'single_end': Token.Literal.String.Single,
+        'double': Token.Literal.String.Double,
+        'double_body': Token.Literal.String.Double,
+        'double_end': Token.Literal.String.Double,
+        'punctuation': Token.Punctuation,
+        'operator': Token.Operator,
+    }
+
+    check_samples = [
+        u"[1, 2, 3, ..., 98, 99, 100]",
+        u"{'a': 1.5, 'b': None, 'c': True}",
+        u'("x", \'\', -3, 0x7f0012345678)',
+        u"<function foo at 0x7f0012345678>",
+        u"<Foo.bar object at 0x7f0012345678>",
+        u"<class 'int'>",
+        u"Decimal('1.2')",
+        u"range(0, 10)",
+        u"{1, 2}",
+        u"Point(x=1, y=2)",
+        u"array([1.5, 2.5])",
+        u"[[1, 2], [3, 4]]",
+        u"<built-in function len>",
+        u"<generator object foo at 0x7f0012345678>",
+        u"frozenset({1})",
+        u"not_a_keyword is None and 1 in x or lambda",
+        u"'with spaces and punctuation, ok?'",
+        u"[.5, -.0, x=.99, {}.1]",
+        u"(y := 1)",
+    ]
+
+    def __init__(self, style):
+        self.style = style
+        self.formatter = formatters[style]
+        self.escapes = {}
+        self.checked = False
+        self.enabled = False
+
+    def escape(self, token_type):
+        # Same lookup as in Terminal256Formatter.format_unencoded
+        try:
+            return self.escapes[token_type]
+        except KeyError:
+            pass
+        result = None
+        ttype = token_type
+        while ttype:
+            try:
+                result = self.formatter.style_string[str(ttype)]
+                break
+            except KeyError:
+                ttype = ttype.parent
+        self.escapes[token_type] = result
+        return result
+
+    def tokens(self, code):
+        """
+        Returns a list of (token type, value) pairs, or None if the code
+        isn't simple enough to be sure of matching pygments.
+        """
+        if not code or code[0] == u' ':
+            return None
+        result = []
+        pos = 0
+        length = len(code)
+        match = self.token_pattern.match
+        types = self.group_token_types
+        while pos < length:
+            m = match(code, pos)
+            if not m:
+                return None
+            group = m.lastgroup
+            if group == 'name':
+                token_type = name_token_type(m.group())
+                if token_type is None:
+                    return None
+                result.append((token_type, m.group()))
+            elif group in ('single_end', 'double_end'):
+                for group in (group[:-4], group[:-4] + '_body', group):
+                    value = m.group(group)
+                    if value:
+                        result.append((types[group], value))
+            else:
+                result.append((types[group], m.group()))
+            pos = m.end()
+        return result
+
+    def fast_highlight(self, code):
+        tokens = self.tokens(code)
+        if tokens is None:
+            return None
+        parts = []
+        for token_type, value in tokens:
+            escape = self.escape(token_type)
+            if escape is None:
+                parts.append(value)
+            else:
+                parts.append(escape[0] + value + escape[1])
+        parts.append(u'\n')
+        return u''.join(parts)
+
+    def check(self):
+        self.checked = True
+        self.enabled = all(
+            self.fast_highlight(sample) in (None, raw_highlight(sample, self.style))
+            for sample in self.check_samples
+        )
+
+    def __call__(self, code):
+        if not self.checked:
+            self.check()
+        if self.enabled:
+            result = self.fast_highlight(code)
+            if result is not None:
+                return result
+        return cached_highlight(code, self.style)
+
+
+@lru_cache(maxsize=1024)
+def name_token_type(name):
+    """
+    Returns the pygments token type of a name, e.g. Name, Name.Builtin, Keyword.Constant,
+    or None if it could change how the following code is tokenized, e.g. 'class' or 'def'.
+    """
+    tokens = list(lexer.get_tokens(name))
+    if len(tokens) != 2:
+        return None
+    token_type, value = tokens[0]
+    if value != name or (
+            token_type in Token.Keyword
+            and token_type is not Token.Keyword.Constant
+    ):
+        return None
+    return token_type
+
+
+lru_cached_functions['name_token_types'] = name_token_type
 
 
 class Event(object):
+    # One is created for each trace callback, so avoid the cost of an instance __dict__
+    __slots__ = (
+        'frame_info', 'frame', 'source', 'last_line_no', 'comprehension_type',
+        'event', 'arg', 'depth', 'variables', 'formatted_prefix', 'line_no', 'code',
+    )
+
+    # The time.time() when the event happened, if it's formatted later, see CapturedEvent
+    time = None
+
+    # The thread the event happened in, if it's formatted in a different thread
+    thread_name = thread_ident = None
+
     def __init__(self, frame_info, event, arg, depth, line_no=None):
         self.frame_info = frame_info
         self.frame = frame = frame_info.frame
@@ -130,7 +420,8 @@ class Event(object):
         self.arg = arg
         self.depth = depth
 
-        self.variables = []
+        self.variables = ()
+        self.formatted_prefix = None
         if line_no is None:
             line_no = frame.f_lineno
         self.line_no = line_no
@@ -142,10 +433,10 @@ class Event(object):
             while True:
                 self.line_no += 1
                 try:
-                    if self.source_line.lstrip().startswith('def'):
+                    if self.source_line.lstrip().startswith(('def', 'async def')):
                         break
                 except IndexError:
-                    self.line_no = self.frame.lineno
+                    self.line_no = frame.f_lineno
                     break
 
     @property
@@ -165,13 +456,179 @@ class Event(object):
     def opname(self):
         return self.opname_at(self.frame.f_lasti)
 
+    @property
+    def is_before_yield_from(self):
+        # Before Python 3.11, a frame suspended in `yield from` or `await`
+        # is at the instruction before YIELD_FROM, which is repeated when it's resumed
+        lasti = self.frame.f_lasti
+        if not PY3 or lasti < 0:
+            return False
+        # The instruction at lasti is LOAD_CONST, which is 3 bytes before Python 3.6
+        index = lasti + (2 if sys.version_info >= (3, 6) else 3)
+        return index < len(self.code.co_code) and self.opname_at(index) == 'YIELD_FROM'
+
     @property
     def is_yield_value(self):
-        for i in range(self.frame.f_lasti, -1, -1):
+        if self.is_before_yield_from:
+            return True
+        # Instructions are 2 bytes since Python 3.6
+        for i in range(self.frame.f_lasti, -1, -2 if sys.version_info >= (3, 6) else -1):
             opname = self.opname_at(i)
             if opname not in ('RESUME', 'CACHE'):
                 return opname == 'YIELD_VALUE'
 
+    @property
+    def return_outcome(self):
+        """
+        For a 'return' event, this is 'return' or 'yield' if a value was
+        returned or yielded, 'exception' if the call was ended
+        by an exception, or 'unknown' if it's impossible to tell.
+        """
+        # If a call ends due to an exception, we still get a 'return' event
+        # with arg = None. This seems to be the only way to tell the difference
+        # https://stackoverflow.com/a/12800909/2482744
+        opname = self.opname
+        if opname == 'YIELD_VALUE' or self.is_before_yield_from:
+            generator_type = self.frame_info.generator_type
+            if generator_type == 'coroutine' or (
+                    generator_type == 'async generator'
+                    and self.arg is unwrap_async_gen_value(self.arg)
+            ):
+                # Suspended by an await rather than a yield
+                return 'await'
+            return 'yield'
+        if self.arg is None:
+            if opname == 'END_FINALLY':
+                if self.frame_info.had_exception:
+                    return 'unknown'
+            elif opname not in ('RETURN_VALUE', 'RETURN_CONST'):
+                return 'exception'
+        return 'return'
+
+    @property
+    def return_value_repr(self):
+        return my_cheap_repr(unwrap_async_gen_value(self.arg))
+
+    def task_name(self):
+        return current_task_name()
+
+    def exception_lines(self):
+        return u''.join(traceback.format_exception_only(*self.arg[:2])).splitlines()
+
+    def executing_node_description(self):
+        """
+        Returns a pair (description, source) of the node that was being
+        executed when an exception was raised, or None if it can't be found.
+        """
+        try:
+            assert not NO_ASTTOKENS
+            ex = Source.executing(self.frame)
+            decorator = getattr(ex, "decorator", None)
+            node = decorator or ex.node
+            assert node
+
+            description = {
+                ast.Call: 'calling',
+                ast.Subscript: 'subscripting',
+                ast.Attribute: 'getting attribute',
+                ast.Compare: 'comparing',
+            }.get(type(node), 'evaluating')
+            source = self.source.get_text_with_indentation(node)
+            if decorator:
+                description = 'calling decorator'
+                source = '@' + source
+            return description, source
+        except Exception:
+            return None
+
+
+class CapturedFrameInfo(object):
+    """
+    The attributes of a FrameInfo used by formatters, without the frame,
+    shared by all captured events with the same values.
+    """
+
+    __slots__ = ('is_ipython_cell', 'generator_type', 'is_generator', 'had_exception')
+
+    def __init__(self, key):
+        self.is_ipython_cell, self.generator_type = key
+        self.is_generator = bool(self.generator_type)
+        self.had_exception = False
+
+
+captured_frame_infos = ArgDefaultDict(CapturedFrameInfo)
+
+
+class CapturedEvent(object):
+    """
+    Provides the same interface to formatters as Event, with everything
+    that depends on the current state of the frame computed up front,
+    so that it can be formatted after the frame has moved on.
+    Used by Tracer(only_if=...), Tracer(on_exception=True), and the flight recorder.
+
+    The frame isn't kept, so that frames and their local variables can be freed
+    while captured events are waiting to be formatted.
+    """
+
+    # The flight recorder may keep many of these
+    __slots__ = (
+        'frame_info', 'frame', 'source', 'code', 'event', 'arg', 'depth',
+        'line_no', 'last_line_no', 'comprehension_type', 'variables',
+        'formatted_prefix', 'time', 'task', 'is_yield_value',
+        'return_outcome', 'return_value_repr', '_exception_lines', '_node_description',
+        # Set by the flight recorder, which formats events from every thread
+        'thread_name', 'thread_ident',
+    )
+
+    def __init__(self, event):
+        frame_info = event.frame_info
+        self.frame_info = captured_frame_infos[frame_info.is_ipython_cell, frame_info.generator_type]
+        self.frame = None
+        self.source = event.source
+        self.code = event.code
+        self.event = event.event
+        # Not kept, to avoid holding on to return values and tracebacks
+        self.arg = None
+        self.depth = event.depth
+        self.line_no = event.line_no
+        self.last_line_no = event.last_line_no
+        self.comprehension_type = event.comprehension_type
+        self.variables = event.variables
+        self.formatted_prefix = None
+        self.time = time.time()
+        self.task = current_task_name()
+        self.thread_name = self.thread_ident = None
+        self.is_yield_value = (
+                event.event == 'call'
+                and frame_info.is_generator
+                and event.is_yield_value
+        )
+        self.return_outcome = self.return_value_repr = None
+        self._exception_lines = self._node_description = None
+        if event.event == 'return':
+            self.return_outcome = event.return_outcome
+            if self.return_outcome in ('return', 'yield'):
+                self.return_value_repr = event.return_value_repr
+        elif event.event == 'exception':
+            self._exception_lines = event.exception_lines()
+            self._node_description = event.executing_node_description()
+
+    @property
+    def source_line(self):
+        return self.source.lines[self.line_no - 1]
+
+    def code_qualname(self):
+        return self.source.code_qualname(self.code)
+
+    def task_name(self):
+        return self.task
+
+    def exception_lines(self):
+        return self._exception_lines
+
+    def executing_node_description(self):
+        return self._node_description
+
 
 class DefaultFormatter(object):
     datetime_format = None
@@ -187,14 +644,15 @@ class DefaultFormatter(object):
             for column in ensure_tuple(columns, split=True)
         ]
         self.column_widths = dict.fromkeys(self.columns, 0)
+        self.thread_local = threading.local()
+        self.start_time = None
         if color is True:
             color = NeutralMonokaiStyle
         if color:
             self.c = Colors
             self.c.grey = formatters[color].style_string["Token.Comment"][0]
 
-            def highlighted(code):
-                return cached_highlight(code, color)
+            highlighted = ReprHighlighter(color)
 
             def highlighted_source_line(event):
                 return event.source.highlighted[color][event.line_no - 1]
@@ -210,18 +668,47 @@ class DefaultFormatter(object):
         self.highlighted = highlighted
         self.highlighted_source_line = highlighted_source_line
 
-    def thread_column(self, _event):
-        return threading.current_thread().name
+    def current_thread(self):
+        # Cached per thread, since threading.current_thread() is relatively slow
+        thread_local = self.thread_local
+        try:
+            return thread_local.name, thread_local.ident
+        except AttributeError:
+            thread = threading.current_thread()
+            thread_local.name = thread.name
+            thread_local.ident = thread.ident
+            return thread.name, thread.ident
+
+    def thread_column(self, event):
+        return event.thread_name or self.current_thread()[0]
+
+    def thread_ident_column(self, event):
+        return event.thread_ident or self.current_thread()[1]
 
-    def thread_ident_column(self, _event):
-        return threading.current_thread().ident
+    def task_column(self, event):
+        return event.task_name() or u''
 
-    def time_column(self, _event):
-        datetime_format = self.datetime_format or '%H:%M:%S.%f'
-        result = datetime.now().strftime(datetime_format)
+    def time_column(self, event):
+        if event.time is None:
+            dt = datetime.now()
+        else:
+            dt = datetime.fromtimestamp(event.time)
+        return self.format_time(dt)
+
+    def format_time(self, dt):
         if self.datetime_format is None:
-            result = result[:-4]
-        return result
+            # Same as dt.strftime('%H:%M:%S.%f')[:-4], but faster
+            return u'%02d:%02d:%02d.%02d' % (dt.hour, dt.minute, dt.second, dt.microsecond // 10000)
+        return dt.strftime(self.datetime_format)
+
+    def elapsed_column(self, event):
+        now = monotonic()
+        if event.time is not None:
+            # The event happened a while before it's being formatted
+            now -= time.time() - event.time
+        if self.start_time is None:
+            self.start_time = now
+        return u'{:.6f}'.format(now - self.start_time)
 
     def file_column(self, event):
         return short_filename(event.code)
@@ -281,37 +768,35 @@ class DefaultFormatter(object):
 
     def format_exception(self, event):
         lines = []
-        exception_string = u''.join(traceback.format_exception_only(*event.arg[:2]))
         lines += [
             u'{c.red}!!! {line}{c.reset}'.format(
                 c=self.c,
                 line=line,
             )
-            for line in exception_string.splitlines()
+            for line in event.exception_lines()
         ]
         lines += self.format_executing_node_exception(event)
         return lines
 
     def format_return(self, event):
-        # If a call ends due to an exception, we still get a 'return' event
-        # with arg = None. This seems to be the only way to tell the difference
-        # https://stackoverflow.com/a/12800909/2482744
-        opname = event.opname
-        arg = event.arg
-        if arg is None:
-            if opname == 'END_FINALLY':
-                if event.frame_info.had_exception:
-                    return [u'{c.red}??? Call either returned None or ended by exception{c.reset}'
-                                .format(c=self.c)]
-            elif opname not in ('RETURN_VALUE', 'YIELD_VALUE'):
-                return [u'{c.red}!!! Call ended by exception{c.reset}'.format(c=self.c)]
+        outcome = event.return_outcome
+        if outcome == 'unknown':
+            return [u'{c.red}??? Call either returned None or ended by exception{c.reset}'
+                        .format(c=self.c)]
+        elif outcome == 'exception':
+            return [u'{c.red}!!! Call ended by exception{c.reset}'.format(c=self.c)]
+        elif outcome == 'await':
+            return [u'{c.green}<<< Await in {func}{c.reset}'.format(
+                c=self.c,
+                func=event.code_qualname(),
+            )]
 
-        value = self.highlighted(my_cheap_repr(arg))
+        value = self.highlighted(event.return_value_repr)
         if event.comprehension_type:
             prefix = plain_prefix = u'Result: '
         else:
             plain_prefix = u'<<< {description} value from {func}: '.format(
-                description='Yield' if opname == 'YIELD_VALUE' else 'Return',
+                description=outcome.capitalize(),
                 func=event.code_qualname(),
             )
             prefix = u'{c.green}{}{c.reset}'.format(
@@ -369,47 +854,40 @@ class DefaultFormatter(object):
                 assert event.event == 'call'
                 if event.frame_info.is_generator:
                     if event.is_yield_value:
-                        description = 'Re-enter generator'
+                        description = 'Re-enter '
                     else:
-                        description = 'Start generator'
+                        description = 'Start '
+                    description += event.frame_info.generator_type
                 else:
                     description = 'Call to'
+            task = ''
+            if event.frame_info.generator_type in ('coroutine', 'async generator'):
+                # Show which task is running, since coroutines in different tasks interleave
+                task_name = event.task_name()
+                if task_name:
+                    task = u' in task {}'.format(task_name)
             return [
-                u'{c.cyan}>>> {description} {name} in File "{filename}", line {lineno}{c.reset}'.format(
+                u'{c.cyan}>>> {description} {name} in File "{filename}", line {lineno}{task}{c.reset}'.format(
                     name=event.code_qualname(),
                     filename=_get_filename(event),
                     lineno=event.line_no,
                     c=self.c,
                     description=description,
+                    task=task,
                 )]
 
     def format_executing_node_exception(self, event):
-        try:
-            assert not NO_ASTTOKENS
-            ex = Source.executing(event.frame)
-            decorator = getattr(ex, "decorator", None)
-            node = decorator or ex.node
-            assert node
-
-            description = {
-                ast.Call: 'calling',
-                ast.Subscript: 'subscripting',
-                ast.Attribute: 'getting attribute',
-                ast.Compare: 'comparing',
-            }.get(type(node), 'evaluating')
-            source = event.source.get_text_with_indentation(node)
-            if decorator:
-                description = 'calling decorator'
-                source = '@' + source
-            plain_prefix = u'!!! When {}: '.format(description)
-            prefix = u'{c.red}{}{c.reset}'.format(plain_prefix, c=self.c)
-            return indented_lines(
-                prefix,
-                source,
-                plain_prefix=plain_prefix
-            )
-        except Exception:
+        node_description = event.executing_node_description()
+        if node_description is None:
             return []
+        description, source = node_description
+        plain_prefix = u'!!! When {}: '.format(description)
+        prefix = u'{c.red}{}{c.reset}'.format(plain_prefix, c=self.c)
+        return indented_lines(
+            prefix,
+            source,
+            plain_prefix=plain_prefix
+        )
 
     def columns_string(self, event):
         column_strings = []
@@ -426,7 +904,7 @@ class DefaultFormatter(object):
         return u'{c.grey}{line_no:4}{c.reset} | {source_line}'.format(
             source_line=self.highlighted_source_line(entry),
             c=self.c,
-            **entry.__dict__
+            line_no=entry.line_no,
         )
 
     def format_variable(self, entry, dots, is_comprehension):
@@ -443,6 +921,55 @@ class DefaultFormatter(object):
         )
         return indented_lines(prefix, self.highlighted(value))
 
+    def format_loop_summary(self, event, loop, iterations, values, changed=()):
+        loop_source_line = event.source.lines[loop.start - 1]
+        dots = (get_leading_spaces(loop_source_line)
+                .replace(' ', '.')
+                .replace('\t', '....'))
+        line = u'......{dots} {c.grey}... {iterations:,} more iteration{s}{c.reset}'.format(
+            dots=dots,
+            iterations=iterations,
+            s='s' * (iterations != 1),
+            c=self.c,
+        )
+        for name, first, last in values:
+            if first == last:
+                value = self.highlighted(first)
+            else:
+                value = u'{} ... {}'.format(self.highlighted(first), self.highlighted(last))
+            line += u', {name} = {value}'.format(name=name, value=value)
+        lines = [line]
+        for var in changed:
+            lines += self.format_variable(var, dots, False)
+        return self.format_lines(event, lines)
+
+    def format_suppressed(self, event, num_events, num_lines):
+        return self.format_lines(event, [
+            u'{c.red}... Output limit reached, skipped {num_events} events '
+            u'({num_lines} lines){c.reset}'.format(
+                c=self.c,
+                num_events=num_events,
+                num_lines=num_lines,
+            )
+        ])
+
+    def format_dropped(self, event, num_events):
+        return self.format_lines(event, [
+            u'{c.grey}... {num_events} earlier events were discarded{c.reset}'.format(
+                c=self.c,
+                num_events=num_events,
+            )
+        ])
+
+    def format_thread_dump(self, event, thread_name, num_events):
+        return self.format_lines(event, [
+            u'{c.cyan}=== Last {num_events:,} events in thread {thread_name}{c.reset}'.format(
+                c=self.c,
+                num_events=num_events,
+                thread_name=thread_name,
+            )
+        ])
+
     def format_line_only(self, event):
         return self.format_lines(event, [self.format_event(event)])
 
@@ -465,7 +992,11 @@ class DefaultFormatter(object):
         return self.format_lines(event, lines)
 
     def format_lines(self, event, lines):
-        prefix = self.full_prefix(event)
+        # Columns are only computed once for all the lines written for an event,
+        # e.g. by several calls to format_log_value from one pp call
+        prefix = event.formatted_prefix
+        if prefix is None:
+            prefix = event.formatted_prefix = self.full_prefix(event)
         return u''.join([
             (
                     prefix
@@ -476,6 +1007,134 @@ class DefaultFormatter(object):
         ])
 
 
+class StructuredFormatter(object):
+    """
+    Formatter which writes one JSON object per line for each event
+    instead of human readable text, so that traces can be captured
+    with little overhead and rendered later with `python -m snoop.render`.
+
+    Each file and code object is described once by a 'file' or 'code' record
+    the first time it appears, and later records refer to it by id.
+    The prefix, columns, and color arguments are ignored.
+    """
+
+    def __init__(self, prefix, columns, color):
+        self.lock = threading.Lock()
+        self.file_ids = {}
+        self.code_ids = {}
+
+    def code_id(self, event, records):
+        code = event.code
+        filename = code.co_filename
+        key = (code, filename)
+        try:
+            return self.code_ids[key]
+        except KeyError:
+            pass
+
+        with self.lock:
+            if key in self.code_ids:
+                return self.code_ids[key]
+
+            if filename not in self.file_ids:
+                file_id = self.file_ids[filename] = len(self.file_ids) + 1
+                records.append(dict(
+                    type='file',
+                    id=file_id,
+                    path=filename,
+                    source=event.source.text or None,
+                ))
+
+            code_id = len(self.code_ids) + 1
+            records.append(dict(
+                type='code',
+                id=code_id,
+                file=self.file_ids[filename],
+                name=code.co_name,
+                qualname=event.code_qualname(),
+                line=code.co_firstlineno,
+            ))
+            self.code_ids[key] = code_id
+            return code_id
+
+    def record(self, entry, record_type, **fields):
+        records = []
+        record = dict(
+            type=record_type,
+            code=self.code_id(entry, records),
+            line=entry.line_no,
+            depth=entry.depth,
+            thread=entry.thread_name or threading.current_thread().name,
+            time=time.time() if entry.time is None else entry.time,
+        )
+        task = entry.task_name()
+        if task:
+            record['task'] = task
+        record.update(fields)
+        records.append(record)
+        return u''.join(
+            six.text_type(json.dumps(r, separators=(',', ':'))) + u'\n'
+            for r in records
+        )
+
+    def format(self, event):
+        # type: (Event) -> str
+        fields = {}
+        if event.variables:
+            fields['vars'] = event.variables
+        if event.last_line_no != event.line_no:
+            fields['last_line'] = event.last_line_no
+        if event.comprehension_type:
+            fields['comprehension'] = event.comprehension_type
+        if event.frame_info.is_ipython_cell:
+            fields['ipython_cell'] = True
+
+        if event.event == 'call' and event.frame_info.is_generator:
+            fields['generator'] = 'resume' if event.is_yield_value else 'start'
+            fields['generator_type'] = event.frame_info.generator_type
+        elif event.event == 'return':
+            fields['outcome'] = outcome = event.return_outcome
+            if outcome in ('return', 'yield'):
+                fields['value'] = event.return_value_repr
+        elif event.event == 'exception':
+            fields['exception'] = event.exception_lines()
+            node_description = event.executing_node_description()
+            if node_description:
+                fields['node'] = node_description
+
+        return self.record(event, 'event', event=event.event, **fields)
+
+    def format_line_only(self, event):
+        return self.record(event, 'line')
+
+    def format_log(self, event):
+        return self.record(event, 'log')
+
+    def format_log_value(self, event, source, value, depth):
+        return self.record(event, 'log_value', source=source, value=value, log_depth=depth)
+
+    def format_loop_summary(self, event, loop, iterations, values, changed=()):
+        fields = {}
+        if changed:
+            fields['changed'] = changed
+        return self.record(
+            event, 'loop',
+            loop_line=loop.start,
+            iterations=iterations,
+            vars=[list(value) for value in values],
+            **fields
+        )
+
+    def format_suppressed(self, event, num_events, num_lines):
+        return self.record(event, 'suppressed', events=num_events, lines=num_lines)
+
+    def format_dropped(self, event, num_events):
+        return self.record(event, 'dropped', events=num_events)
+
+    def format_thread_dump(self, event, thread_name, num_events):
+        return self.record(event, 'thread_dump', thread_name=thread_name, events=num_events)
+
+
 def get_leading_spaces(s):
     return s[:len(s) - len(s.lstrip())]
 
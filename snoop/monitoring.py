@@ -0,0 +1,246 @@
+"""
+Alternative tracing backend built on sys.monitoring (PEP 669), available in Python 3.12+.
+
+sys.settrace calls the global trace function for every frame in the program
+while a tracer is active, even though Tracer.trace immediately rejects most of them.
+sys.monitoring lets us enable events only for the code objects we care about
+(target functions, with blocks, and callees within the tracer's depth),
+so untraced code runs at full speed.
+
+Events are translated into the same (frame, event, arg) calls that sys.settrace
+would make, so Tracer.trace doesn't need to know which backend is in use.
+"""
+
+import sys
+import threading
+from bisect import bisect_right
+
+from .utils import LRUCache
+
+monitoring = getattr(sys, 'monitoring', None)
+available = monitoring is not None
+
+if available:
+    events = monitoring.events
+
+    # Events for frames which we may trace, enabled per code object
+    LOCAL_EVENTS = (
+            events.PY_START | events.PY_RESUME |
+            events.PY_RETURN | events.PY_YIELD | events.STOP_ITERATION |
+            events.LINE | events.JUMP | events.BRANCH
+    )
+
+    # Events which can't be enabled per code object.
+    # They only happen when exceptions are raised,
+    # so they're enabled globally while any tracer is active.
+    EXCEPTION_EVENTS = (
+            events.PY_THROW | events.PY_UNWIND |
+            events.RAISE | events.EXCEPTION_HANDLED
+    )
+
+    # Events needed to find callees within the depth of a tracer,
+    # enabled globally while such a tracer is active
+    CALL_EVENTS = events.PY_START | events.PY_RESUME
+
+
+class MonitoringEngine(object):
+    """
+    Process-wide singleton (sys.monitoring tool IDs are global) that dispatches
+    events to the innermost active tracer in the current thread,
+    mimicking sys.settrace and frame.f_trace.
+    """
+
+    def __init__(self):
+        self.tool_id = None
+        self.failed = False
+        self.lock = threading.Lock()
+        self.thread_state = threading.local()
+        self.line_tables = LRUCache('line_tables', self.make_line_table)
+        # Number of active tracers in all threads, and those with depth > 1
+        self.users = 0
+        self.deep_users = 0
+        # Code objects with local events enabled, by id
+        # (distinct code objects can compare equal)
+        self.watched_codes = {}
+
+    def activate(self):
+        """
+        Claims a tool ID and registers callbacks the first time it's called.
+        Returns False if sys.monitoring can't be used, in which case
+        the caller should fall back to sys.settrace.
+        """
+        if self.tool_id is not None:
+            return True
+        if self.failed or not available:
+            return False
+
+        with self.lock:
+            if self.tool_id is None and not self.failed:
+                tool_id = monitoring.DEBUGGER_ID
+                try:
+                    monitoring.use_tool_id(tool_id, 'snoop')
+                except ValueError:
+                    # Another debugger is using sys.monitoring
+                    self.failed = True
+                    return False
+
+                for event, callback in [
+                    (events.PY_START, self.call_callback),
+                    (events.PY_RESUME, self.call_callback),
+                    (events.PY_THROW, self.throw_callback),
+                    (events.PY_RETURN, self.return_callback),
+                    (events.PY_YIELD, self.return_callback),
+                    (events.PY_UNWIND, self.unwind_callback),
+                    (events.RAISE, self.exception_callback),
+                    (events.STOP_ITERATION, self.exception_callback),
+                    (events.EXCEPTION_HANDLED, self.exception_handled_callback),
+                    (events.LINE, self.line_callback),
+                    (events.JUMP, self.jump_callback),
+                    (events.BRANCH, self.jump_callback),
+                ]:
+                    monitoring.register_callback(tool_id, event, callback)
+                self.tool_id = tool_id
+
+        return self.tool_id is not None
+
+    def state(self):
+        state = self.thread_state
+        if not hasattr(state, 'stack'):
+            # Active trace functions, innermost last, like nested sys.settrace calls
+            state.stack = []
+            # Local trace functions, like frame.f_trace
+            state.frame_traces = {}
+        return state
+
+    def watch_code(self, code):
+        if id(code) not in self.watched_codes:
+            with self.lock:
+                self.watched_codes[id(code)] = code
+                monitoring.set_local_events(self.tool_id, code, LOCAL_EVENTS)
+
+    def push(self, trace, depth):
+        self.state().stack.append(trace)
+        with self.lock:
+            self.users += 1
+            self.deep_users += depth > 1
+            self.set_global_events()
+
+    def pop(self, depth):
+        """
+        Deactivates the innermost trace function in this thread
+        and returns the one that was active before it, if any.
+        When no tracer is active in any thread, all events are disabled again,
+        so that untraced code doesn't call back into Python at all.
+        """
+        stack = self.state().stack
+        stack.pop()
+        with self.lock:
+            self.users -= 1
+            self.deep_users -= depth > 1
+            self.set_global_events()
+            if not self.users:
+                for code in self.watched_codes.values():
+                    monitoring.set_local_events(self.tool_id, code, 0)
+                self.watched_codes.clear()
+        return stack[-1] if stack else None
+
+    def set_global_events(self):
+        # Called with self.lock held
+        event_set = 0
+        if self.users:
+            event_set |= EXCEPTION_EVENTS
+        if self.deep_users:
+            event_set |= CALL_EVENTS
+        if monitoring.get_events(self.tool_id) != event_set:
+            monitoring.set_events(self.tool_id, event_set)
+
+    def set_frame_trace(self, frame, trace):
+        frame_traces = self.state().frame_traces
+        if trace is None:
+            frame_traces.pop(frame, None)
+        else:
+            frame_traces[frame] = trace
+
+    @staticmethod
+    def make_line_table(code):
+        starts = []
+        lines = []
+        for start, _end, line in code.co_lines():
+            starts.append(start)
+            lines.append(line)
+        return starts, lines
+
+    def line_at(self, code, offset):
+        starts, lines = self.line_tables[code]
+        return lines[bisect_right(starts, offset) - 1]
+
+    def call_callback(self, code, _offset):
+        self.dispatch_call(code)
+
+    def throw_callback(self, code, _offset, _exception):
+        self.dispatch_call(code)
+
+    def dispatch_call(self, code):
+        state = self.thread_state
+        stack = getattr(state, 'stack', None)
+        if not stack:
+            return
+
+        frame = sys._getframe(2)
+        result = stack[-1](frame, 'call', None)
+        if result is not None:
+            self.watch_code(code)
+            state.frame_traces[frame] = result
+
+    def dispatch(self, event, arg, is_return=False):
+        state = self.thread_state
+        frame_traces = getattr(state, 'frame_traces', None)
+        if not frame_traces:
+            return
+
+        frame = sys._getframe(2)
+        trace = frame_traces.get(frame)
+        if trace is None:
+            return
+
+        result = None
+        try:
+            result = trace(frame, event, arg)
+        finally:
+            # Forget the frame even if the trace function raised an exception
+            if result is None or is_return:
+                frame_traces.pop(frame, None)
+            else:
+                frame_traces[frame] = result
+
+    def return_callback(self, _code, _offset, retval):
+        self.dispatch('return', retval, is_return=True)
+
+    def unwind_callback(self, _code, _offset, _exception):
+        # sys.settrace reports a 'return' event with arg None
+        # when a frame is exited by an exception
+        self.dispatch('return', None, is_return=True)
+
+    def exception_callback(self, _code, _offset, exception):
+        self.dispatch('exception', (type(exception), exception, exception.__traceback__))
+
+    def line_callback(self, _code, _line_number):
+        self.dispatch('line', None)
+
+    def jump_callback(self, code, source, destination):
+        # sys.settrace reports a 'line' event when jumping backwards
+        # to the same line, e.g. in a one-line loop.
+        # Other jumps are covered by LINE events.
+        if destination > source or self.line_at(code, source) != self.line_at(code, destination):
+            return monitoring.DISABLE
+        self.dispatch('line', None)
+
+    def exception_handled_callback(self, code, offset, _exception):
+        # sys.settrace reports a 'line' event when an exception is caught
+        # by a handler on the same line as the raising instruction
+        frame = sys._getframe(1)
+        if frame.f_lineno == self.line_at(code, offset):
+            self.dispatch('line', None)
+
+
+engine = MonitoringEngine()
@@ -100,9 +100,11 @@ class PPEvent(object):
     def deep_pp(self, call_arg, frame):
         stack = []
         thread = current_thread()
+        # Assigns _tree_index and _depth to all nodes, including call_arg
+        nodes = self.event.source.nodes
 
         def before_expr(tree_index):
-            node = self.event.source.nodes[tree_index]
+            node = nodes[tree_index]
             if thread == current_thread():
                 stack.append(node)
             return node
@@ -0,0 +1,94 @@
+"""
+Measures where snoop's own overhead goes, enabled with Config(profile_overhead=True).
+
+Rather than checking whether profiling is enabled everywhere,
+the relevant functions are wrapped when it is, so that normal tracing isn't slowed down.
+"""
+
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class OverheadProfiler(object):
+    # Categories in the order they're reported, with descriptions
+    categories = OrderedDict([
+        ('trace', 'trace callbacks'),
+        ('frame_info', 'frame setup (FrameInfo)'),
+        ('update_variables', 'update_variables'),
+        ('repr', 'repr of values'),
+        ('format', 'formatting'),
+        ('write', 'writing output'),
+    ])
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.times = dict.fromkeys(self.categories, 0.0)
+            self.counts = dict.fromkeys(self.categories, 0)
+            self.rejected = 0
+
+    def add(self, category, start):
+        elapsed = timer() - start
+        with self.lock:
+            self.times[category] += elapsed
+            self.counts[category] += 1
+
+    def wrap(self, category, func):
+        add = self.add
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add(category, start)
+
+        return wrapper
+
+    def wrap_trace(self, trace):
+        """
+        Wraps a trace function, additionally counting the calls
+        which weren't traced, i.e. where the trace function returned None.
+        """
+        add = self.add
+
+        def wrapper(frame, event, arg):
+            start = timer()
+            result = trace(frame, event, arg)
+            add('trace', start)
+            if result is None and event == 'call':
+                with self.lock:
+                    self.rejected += 1
+            return result
+
+        return wrapper
+
+    def report(self):
+        """
+        Returns a summary of the time spent so far in each part of snoop.
+        Time in the trace callbacks includes the other categories,
+        except for pp which runs outside of them.
+        """
+        with self.lock:
+            lines = [u'snoop overhead:']
+            for category, description in self.categories.items():
+                count = self.counts[category]
+                total = self.times[category]
+                line = u'    {:28} {:10.6f}s {:10,} calls {:10.2f} us/call'.format(
+                    description + ':',
+                    total,
+                    count,
+                    total / count * 1e6 if count else 0,
+                )
+                if category == 'trace':
+                    line += u' ({:,} for untraced frames)'.format(self.rejected)
+                lines.append(line)
+        return u''.join(line + u'\n' for line in lines)
@@ -0,0 +1,169 @@
+"""
+Flight recorder mode, started with snoop.flight_recorder().
+
+Instead of being written, traced events are captured unformatted in a bounded
+buffer for each thread, and only formatted when they're dumped.
+"""
+
+import signal
+import sys
+import threading
+from collections import deque
+
+import snoop as package
+from snoop.configuration import get_write_function
+
+default_dump_signal = getattr(signal, 'SIGUSR1', None)
+dump_thread_name = 'snoop flight recorder dump'
+
+
+class FlightRecorder(object):
+    """
+    Keeps the last `size` events traced in each thread, unformatted,
+    so that they can be written with dump() when something goes wrong.
+    """
+
+    def __init__(self, config, size):
+        self.config = config
+        self.size = size
+        self.thread_local = threading.local()
+        # Maps each live thread to its events, for dump()
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.previous_signal_handler = None
+        self.dump_signal = None
+        self.previous_excepthook = None
+        self.previous_threading_excepthook = None
+
+    def record(self, method, event, args):
+        """
+        Keeps an event captured by the tracer, to be formatted
+        later with the given formatter method and extra arguments.
+        """
+        try:
+            events = self.thread_local.events
+        except AttributeError:
+            events = self._start_thread()
+        events.append((method, event, args))
+
+    def _start_thread(self):
+        events = self.thread_local.events = deque(maxlen=self.size)
+        with self.lock:
+            # Forget threads that have finished, so that memory stays bounded
+            # in programs which start many threads
+            for thread in list(self.threads):
+                if not thread.is_alive():
+                    del self.threads[thread]
+            self.threads[threading.current_thread()] = events
+        return events
+
+    def dump(self, out=None):
+        """
+        Formats and writes the recorded events, oldest first, one thread
+        at a time, then forgets them.
+
+        `out` has the same meaning as in `install()`.
+        By default the output of the config is used.
+        """
+        if out is None:
+            write = self.config.write
+        else:
+            write = get_write_function(out, overwrite=False)
+        formatter = self.config.formatter
+
+        with self.lock:
+            threads = list(self.threads.items())
+
+        for thread, events in threads:
+            recorded = take_all(events)
+            if not recorded:
+                continue
+            for _, event, _ in recorded:
+                event.thread_name = thread.name
+                event.thread_ident = thread.ident
+            write(formatter.format_thread_dump(recorded[0][1], thread.name, len(recorded)))
+            for method, event, args in recorded:
+                write(getattr(formatter, method)(event, *args))
+
+    def start(self, dump_signal, dump_on_exception):
+        self.config.recorder = self
+        if dump_signal is not None:
+            self.dump_signal = dump_signal
+            self.previous_signal_handler = signal.signal(dump_signal, self._signal_handler)
+        if dump_on_exception:
+            self.previous_excepthook = sys.excepthook
+            sys.excepthook = self._excepthook
+            if hasattr(threading, 'excepthook'):
+                self.previous_threading_excepthook = threading.excepthook
+                threading.excepthook = self._threading_excepthook
+
+    def stop(self):
+        """
+        Stops recording and restores the signal handler and exception hooks.
+        Recorded events are discarded.
+        """
+        if self.config.recorder is self:
+            self.config.recorder = None
+        if self.dump_signal is not None:
+            signal.signal(self.dump_signal, self.previous_signal_handler)
+            self.dump_signal = None
+        # Only restore hooks which haven't been replaced since
+        if self.previous_excepthook is not None:
+            if sys.excepthook == self._excepthook:
+                sys.excepthook = self.previous_excepthook
+            self.previous_excepthook = None
+        if self.previous_threading_excepthook is not None:
+            if threading.excepthook == self._threading_excepthook:
+                threading.excepthook = self.previous_threading_excepthook
+            self.previous_threading_excepthook = None
+        with self.lock:
+            self.threads.clear()
+
+    def _signal_handler(self, _signum, _frame):
+        # The interrupted code may be holding a lock that writing needs,
+        # e.g. in FileWriter, so dumping here could deadlock
+        thread = threading.Thread(target=self.dump, name=dump_thread_name)
+        thread.start()
+
+    def _excepthook(self, *args):
+        self.dump()
+        self.previous_excepthook(*args)
+
+    def _threading_excepthook(self, args):
+        self.dump()
+        self.previous_threading_excepthook(args)
+
+
+def take_all(events):
+    while True:
+        try:
+            result = list(events)
+        except RuntimeError:
+            # Another thread recorded an event while copying
+            continue
+        # Events recorded since copying are lost, which is rare and harmless
+        events.clear()
+        return result
+
+
+def flight_recorder(size=100000, dump_signal=default_dump_signal, dump_on_exception=True, config=None):
+    """
+    Starts recording traced events instead of writing them.
+    Returns a FlightRecorder whose dump() method writes the last `size` events
+    of each thread, and stop() method goes back to writing output normally.
+
+    - `dump_signal`: dump when the process receives this signal, SIGUSR1 by default
+        (where it exists), from a new thread. Pass None to not install a signal handler.
+        Otherwise this must be called from the main thread.
+    - `dump_on_exception`: dump when an exception isn't caught, in any thread.
+    - `config`: the `Config` whose tracers should record.
+        By default this is the global configuration from `install()`.
+    """
+    if config is None:
+        config = package.snoop.config
+    if config.recorder is not None:
+        config.recorder.stop()
+    assert size >= 1
+    recorder = FlightRecorder(config, size)
+    recorder.start(dump_signal, dump_on_exception)
+    return recorder
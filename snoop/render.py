@@ -0,0 +1,215 @@
+"""
+Renders a trace recorded with StructuredFormatter as the usual snoop output:
+
+    python -m snoop.render trace.jsonl | less -R
+
+Records are read and rendered one at a time, so traces of any size
+can be rendered without loading them into memory.
+Only file and code metadata is kept.
+"""
+
+import argparse
+import errno
+import io
+import json
+import sys
+from datetime import datetime
+
+from snoop.configuration import can_color
+from snoop.formatting import DefaultFormatter, Source
+from snoop.utils import shitcode
+
+
+class RecordedCode(object):
+    """
+    Stands in for a code object, providing the attributes used by columns.
+    """
+
+    def __init__(self, record, source):
+        self.co_filename = source.filename
+        self.co_name = record['name']
+        self.co_firstlineno = record['line']
+        self.qualname = record['qualname']
+        self.source = source
+
+
+class RecordedFrameInfo(object):
+    def __init__(self, record):
+        self.is_ipython_cell = record.get('ipython_cell', False)
+        self.is_generator = 'generator' in record
+        self.generator_type = record.get('generator_type', 'generator' if self.is_generator else '')
+        self.had_exception = False
+
+
+class RecordedEvent(object):
+    """
+    Provides the same interface to formatters as formatting.Event,
+    using values from a record instead of a live frame.
+    """
+
+    def __init__(self, record, code):
+        self.frame_info = RecordedFrameInfo(record)
+        self.source = code.source
+        self.code = code
+        self.event = record.get('event')
+        self.arg = None
+        self.depth = record['depth']
+        self.line_no = record['line']
+        self.last_line_no = record.get('last_line', self.line_no)
+        self.comprehension_type = record.get('comprehension')
+        self.variables = [tuple(var) for var in record.get('vars', ())]
+        self.thread = record['thread']
+        self.time = record['time']
+        self.is_yield_value = record.get('generator') == 'resume'
+        self.return_outcome = record.get('outcome')
+        self.return_value_repr = record.get('value')
+        self.formatted_prefix = None
+        self.record = record
+
+    @property
+    def source_line(self):
+        return self.source.lines[self.line_no - 1]
+
+    def code_qualname(self):
+        return self.code.qualname
+
+    def task_name(self):
+        return self.record.get('task')
+
+    def exception_lines(self):
+        return self.record['exception']
+
+    def executing_node_description(self):
+        node = self.record.get('node')
+        return node and tuple(node)
+
+
+class RecordedLoop(object):
+    def __init__(self, start):
+        self.start = start
+
+
+class RenderFormatter(DefaultFormatter):
+    """
+    DefaultFormatter which takes the thread and time columns
+    from the recorded events.
+    """
+
+    def thread_column(self, event):
+        return event.thread
+
+    def thread_ident_column(self, _event):
+        # Not recorded
+        return u''
+
+    def elapsed_column(self, event):
+        if self.start_time is None:
+            self.start_time = event.time
+        return u'{:.6f}'.format(event.time - self.start_time)
+
+    def time_column(self, event):
+        return self.format_time(datetime.fromtimestamp(event.time))
+
+
+def recorded_source(record):
+    text = record.get('source')
+    if text is None:
+        # Fall back to the file on disk, if it's there
+        return Source.for_filename(record['path'])
+    return Source(record['path'], text.splitlines(True))
+
+
+def render(records, formatter, write):
+    """
+    Renders an iterable of JSON strings (e.g. lines of a file)
+    produced by StructuredFormatter, passing the output to write.
+    """
+    sources = {}
+    codes = {}
+    for record in records:
+        record = record.strip()
+        if not record:
+            continue
+        record = json.loads(record)
+        record_type = record['type']
+
+        if record_type == 'file':
+            sources[record['id']] = recorded_source(record)
+            continue
+        if record_type == 'code':
+            codes[record['id']] = RecordedCode(record, sources[record['file']])
+            continue
+
+        event = RecordedEvent(record, codes[record['code']])
+        if record_type == 'event':
+            formatted = formatter.format(event)
+        elif record_type == 'line':
+            formatted = formatter.format_line_only(event)
+        elif record_type == 'log':
+            formatted = formatter.format_log(event)
+        elif record_type == 'log_value':
+            formatted = formatter.format_log_value(
+                event, record['source'], record['value'], record['log_depth'])
+        elif record_type == 'loop':
+            formatted = formatter.format_loop_summary(
+                event, RecordedLoop(record['loop_line']), record['iterations'], record['vars'],
+                record.get('changed', ()))
+        elif record_type == 'suppressed':
+            formatted = formatter.format_suppressed(event, record['events'], record['lines'])
+        elif record_type == 'dropped':
+            formatted = formatter.format_dropped(event, record['events'])
+        elif record_type == 'thread_dump':
+            formatted = formatter.format_thread_dump(event, record['thread_name'], record['events'])
+        else:
+            raise ValueError('Unknown record type: {!r}'.format(record_type))
+
+        write(formatted)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m snoop.render',
+        description='Render a trace recorded with snoop.formatting.StructuredFormatter.',
+    )
+    parser.add_argument('path', help="Path to the trace file, or '-' to read from stdin")
+    parser.add_argument('--prefix', default='', help='String to start all lines with')
+    parser.add_argument('--columns', default='time',
+                        help='Columns to show, separated by spaces or commas, '
+                             'as for snoop.install()')
+    parser.add_argument('--color', nargs='?', const=True, default=None, metavar='STYLE',
+                        help='Force colored output, optionally with a pygments style')
+    parser.add_argument('--no-color', dest='color', action='store_false',
+                        help='Disable colored output')
+    args = parser.parse_args(argv)
+
+    color = args.color
+    if not can_color:
+        color = False
+    elif color is None:
+        color = sys.stdout.isatty()
+
+    formatter = RenderFormatter(args.prefix, args.columns, color)
+
+    def write(s):
+        try:
+            sys.stdout.write(s)
+        except UnicodeEncodeError:
+            sys.stdout.write(shitcode(s))
+
+    if args.path == '-':
+        f = sys.stdin
+    else:
+        f = io.open(args.path, encoding='utf8')
+
+    try:
+        with f:
+            render(f, formatter, write)
+        sys.stdout.flush()
+    except IOError as e:
+        # e.g. the output was piped to head or less which exited
+        if e.errno != errno.EPIPE:
+            raise
+
+
+if __name__ == '__main__':
+    main()
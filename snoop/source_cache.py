@@ -0,0 +1,108 @@
+"""
+On-disk cache of syntax highlighted source files, so that new processes
+don't have to highlight a large file again the first time
+a function in it is traced.
+
+Entries are JSON files named after a hash of the source file's path,
+and are only used if the hash of the file's contents
+and the version of pygments are the same as when they were written.
+Files are replaced atomically so that processes can share a directory.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import pygments
+import six
+
+# Increase when the format of entries changes
+CACHE_VERSION = 1
+
+
+def style_key(style):
+    if isinstance(style, six.string_types):
+        return style
+    return u'{}.{}'.format(style.__module__, getattr(style, '__qualname__', style.__name__))
+
+
+def text_hash(text):
+    if isinstance(text, six.text_type):
+        text = text.encode('utf8')
+    return hashlib.sha1(text).hexdigest()
+
+
+class SourceCache(object):
+    def __init__(self):
+        self.directory = None
+        self.lock = threading.Lock()
+
+    def entry_path(self, filename):
+        name = hashlib.sha1(six.text_type(filename).encode('utf8')).hexdigest()
+        return os.path.join(self.directory, name + '.json')
+
+    def load(self, filename, text):
+        """
+        Returns the cached entry for this source file (a dict),
+        which is empty if the file isn't cached or has changed since.
+        """
+        metadata = dict(
+            version=CACHE_VERSION,
+            pygments=pygments.__version__,
+            hash=text_hash(text),
+        )
+        try:
+            with open(self.entry_path(filename)) as f:
+                entry = json.load(f)
+            if all(entry.get(key) == value for key, value in metadata.items()):
+                return entry
+        except (IOError, OSError, ValueError):
+            pass
+
+        metadata.update(highlighted={})
+        return metadata
+
+    def save(self, filename, entry):
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            # Atomic, so readers never see a partially written entry
+            if hasattr(os, 'replace'):
+                os.replace(temp_path, self.entry_path(filename))
+            else:
+                os.rename(temp_path, self.entry_path(filename))
+        except (IOError, OSError):
+            pass
+
+    def highlighted_lines(self, source, style, highlight):
+        """
+        Returns the highlighted lines of the source text in the given style,
+        either from the cache or by calling highlight(text, style)
+        and then storing the result.
+        """
+        if not self.directory:
+            return highlight(source.text, style).splitlines()
+
+        entry = source.cache_entry
+        if entry is None:
+            entry = source.cache_entry = self.load(source.filename, source.text)
+
+        key = style_key(style)
+        try:
+            return entry['highlighted'][key]
+        except KeyError:
+            pass
+
+        lines = highlight(source.text, style).splitlines()
+        with self.lock:
+            entry['highlighted'][key] = lines
+            self.save(source.filename, entry)
+        return lines
+
+
+source_cache = SourceCache()
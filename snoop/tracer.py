@@ -1,22 +1,27 @@
+import ast
 import functools
 import inspect
 import os
+import random
 import re
 import sys
 import threading
-from collections import OrderedDict
+import time
+from collections import OrderedDict, deque
 
 import six
 # noinspection PyUnresolvedReferences
 from cheap_repr import cheap_repr, find_repr_function, try_register_repr
 
-from snoop.utils import (NO_BIRDSEYE, PY34, ArgDefaultDict,
-                         _register_cheap_reprs, ensure_tuple,
-                         is_comprehension_frame, iscoroutinefunction,
-                         my_cheap_repr, no_args_decorator, pp_name_prefix,
-                         truncate_list)
+from snoop.utils import (IMMUTABLE, NO_BIRDSEYE, PY34, LRUCache,
+                         _register_cheap_reprs, current_task, ensure_tuple,
+                         get_generator_type, is_await_stop,
+                         is_comprehension_frame, isasyncgenfunction,
+                         iscoroutinefunction, my_cheap_repr,
+                         no_args_decorator, pp_name_prefix, truncate_list)
 
-from .formatting import Event, Source
+from .formatting import CapturedEvent, Event, Source
+from .monitoring import engine as monitoring_engine
 from .variables import BaseVariable, CommonVariable, Exploding
 
 find_repr_function(six.text_type).maxparts = 100
@@ -26,15 +31,30 @@ find_repr_function(int).maxparts = 999999
 cheap_repr.suppression_threshold = 999999
 
 
+# Plain dicts keep their insertion order since Python 3.7, and are cheaper than OrderedDict
+ordered_dict = dict if sys.version_info >= (3, 7) else OrderedDict
+
+
 class FrameInfo(object):
+    __slots__ = (
+        'frame', 'local_reprs', 'local_values', 'last_line_no', 'comprehension_variables',
+        'source', 'generator_type', 'is_generator', 'had_exception', 'comprehension_type',
+        'is_ipython_cell', 'loops',
+    )
+
+    # Replaced when profiling overhead, otherwise my_cheap_repr is used
+    repr_value = None
+
     def __init__(self, frame):
         self.frame = frame
         self.local_reprs = {}
+        self.local_values = {}
         self.last_line_no = frame.f_lineno
-        self.comprehension_variables = OrderedDict()
+        self.comprehension_variables = ordered_dict()
         self.source = Source.for_frame(frame)
         code = frame.f_code
-        self.is_generator = code.co_flags & inspect.CO_GENERATOR
+        self.generator_type = get_generator_type(code)
+        self.is_generator = bool(self.generator_type)
         self.had_exception = False
         if is_comprehension_frame(frame):
             self.comprehension_type = (
@@ -47,15 +67,37 @@ class FrameInfo(object):
                 code.co_name == '<module>' and
                 code.co_filename.startswith('<ipython-input-')
         )
+        self.loops = []
 
-    def update_variables(self, watch, watch_extras, event, whitelist):
+    def update_variables(self, watch, watch_extras, event, whitelist, fingerprint=None):
         self.last_line_no = self.frame.f_lineno
         old_local_reprs = self.local_reprs
-        self.local_reprs = OrderedDict(
-            (source, my_cheap_repr(value))
-            for source, value in
-            self.get_local_reprs(watch, watch_extras, whitelist)
-        )
+        old_local_values = self.local_values
+        self.local_reprs = local_reprs = ordered_dict()
+        self.local_values = local_values = {}
+        repr_value = self.repr_value or my_cheap_repr
+        for source, value in self.get_local_reprs(watch, watch_extras, whitelist):
+            old_value, old_fingerprint = old_local_values.get(source, (None, None))
+            if old_fingerprint is IMMUTABLE and old_value is value:
+                # No need to call fingerprint again
+                new_fingerprint = IMMUTABLE
+            else:
+                new_fingerprint = None
+                if fingerprint is not None:
+                    try:
+                        new_fingerprint = fingerprint(value)
+                    except Exception:
+                        pass
+
+            if (
+                    new_fingerprint is not None
+                    and old_value is value
+                    and new_fingerprint == old_fingerprint
+            ):
+                local_reprs[source] = old_local_reprs[source]
+            else:
+                local_reprs[source] = repr_value(value)
+            local_values[source] = (value, new_fingerprint)
 
         if self.comprehension_type:
             for name, value_repr in self.local_reprs.items():
@@ -80,16 +122,23 @@ class FrameInfo(object):
     def get_local_reprs(self, watch, watch_extras, whitelist):
         frame = self.frame
         code = frame.f_code
+        f_locals = frame.f_locals
         var_names = [
-            key for key in frame.f_locals
+            key for key in f_locals
             if whitelist is None or key in whitelist
             if not key.startswith(pp_name_prefix)
         ]
-        vars_order = code.co_varnames + code.co_cellvars + code.co_freevars + tuple(var_names)
-        var_names.sort(key=vars_order.index)
+        ranks = code_var_ranks[code]
+        num_ranks = len(ranks)
+        # Variables not belonging to the code (e.g. in a class body) go last,
+        # in the order they appear in f_locals
+        var_names = sorted(
+            (ranks.get(key, num_ranks + i), key)
+            for i, key in enumerate(var_names)
+        )
         result_items = [
-            (key, frame.f_locals[key])
-             for key in var_names
+            (key, f_locals[key])
+            for _, key in var_names
         ]
 
         for variable in watch:
@@ -108,6 +157,134 @@ class FrameInfo(object):
                         yield pair
 
 
+class Loop(object):
+    """
+    A for/while loop running in a frame, for Tracer(collapse_loops=...)
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.start = node.lineno
+        # The else block of a loop isn't part of it
+        last_statement = node.body[-1]
+        self.end = getattr(last_statement, 'end_lineno', None) or max(
+            getattr(child, 'lineno', 0)
+            for child in ast.walk(last_statement)
+        )
+        self.target_names = []
+        if not isinstance(node, ast.While):
+            for child in ast.walk(node.target):
+                if isinstance(child, ast.Name) and child.id not in self.target_names:
+                    self.target_names.append(child.id)
+
+        # Number of times the loop header has been reached
+        self.iterations = 1
+
+        # Iterations not shown since the last summary
+        self.skipped = 0
+        self.first_values = None
+        self.last_values = None
+
+    def record_iteration(self, f_locals):
+        self.skipped += 1
+        self.last_values = [f_locals.get(name) for name in self.target_names]
+        if self.first_values is None:
+            self.first_values = [my_cheap_repr(value) for value in self.last_values]
+
+
+class CallSampler(object):
+    """
+    Decides which calls to one function decorated by a Tracer are traced,
+    for Tracer(sample_rate=..., every=..., max_calls=...).
+    Each function is counted separately, and the tracer's lock keeps the counts
+    exact when it's called from several threads.
+    Once max_calls calls have been traced, later calls are rejected
+    without taking the lock and aren't counted.
+    """
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self.traced_calls = 0
+        self.skipped_calls = 0
+        self.exhausted = tracer.max_calls == 0
+
+    def __call__(self):
+        if self.exhausted:
+            return False
+
+        tracer = self.tracer
+        sample = tracer.sample_rate is None or random.random() < tracer.sample_rate
+        with tracer.sampling_lock:
+            calls = self.traced_calls + self.skipped_calls
+            if (
+                    self.exhausted
+                    or (tracer.every is not None and calls % tracer.every)
+                    or not sample
+            ):
+                self.skipped_calls += 1
+                tracer.skipped_calls += 1
+                return False
+
+            self.traced_calls += 1
+            tracer.traced_calls += 1
+            if tracer.max_calls is not None and self.traced_calls >= tracer.max_calls:
+                self.exhausted = True
+            return True
+
+
+class BufferedCall(object):
+    """
+    Output of a call traced with Tracer(only_if=...) or Tracer(on_exception=True),
+    kept unformatted until the condition is met.
+    """
+
+    def __init__(self, buffer_size):
+        # Pairs (formatter method name, CapturedEvent, extra arguments)
+        self.events = deque(maxlen=buffer_size)
+
+        # Number of events pushed out of the buffer by newer ones
+        self.dropped = 0
+
+        # True once the condition is met and output is written directly
+        self.triggered = False
+
+    def append(self, method, event, args=()):
+        captured = CapturedEvent(event)
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append((method, captured, args))
+
+
+class ThreadFrames(object):
+    """
+    The bookkeeping of a Tracer about the frames it's tracing in one thread.
+    It's kept per thread so that it's freed when the thread exits, and so that
+    the outermost `with` block in a thread can safely clear anything left over.
+    Frames can't be weakly referenced, so each frame must be removed explicitly.
+    """
+    __slots__ = ('frame_infos', 'frame_distances', 'blocks')
+
+    def __init__(self, frame_info_class):
+        self.frame_infos = LRUCache('frame_infos', frame_info_class)
+        # Maps each frame being traced to the number of calls between it
+        # and the target frame it descends from, not counting comprehensions,
+        # so that a new frame only has to look up its parent to know its depth
+        self.frame_distances = {}
+        # Whether the tracer was enabled when each current with block started
+        self.blocks = []
+
+
+def get_var_ranks(code):
+    ranks = {}
+    for name in code.co_varnames + code.co_cellvars + code.co_freevars:
+        ranks.setdefault(name, len(ranks))
+    return ranks
+
+
+# Maps each code object to a dict {variable name: position},
+# used to sort variables in the order they're defined
+code_var_ranks = LRUCache('code_var_ranks', get_var_ranks)
+
 thread_global = threading.local()
 internal_directories = (os.path.dirname((lambda: 0).__code__.co_filename),)
 
@@ -119,6 +296,25 @@ except ImportError:
 else:
     internal_directories += (os.path.dirname(birdseye.__file__),)
 
+# Flags describing a code object, used by Tracer.trace
+# to quickly reject frames that it shouldn't trace
+COMPREHENSION = 1
+INTERNAL = 2
+
+
+def get_code_flags(code):
+    flags = 0
+    if code.co_name in ('<listcomp>', '<dictcomp>', '<setcomp>'):
+        flags |= COMPREHENSION
+    if code.co_filename.startswith(internal_directories):
+        flags |= INTERNAL
+    return flags
+
+
+# Maps each code object to its flags, so that rejecting a frame
+# usually only costs a few dict lookups
+code_flags = LRUCache('code_flags', get_code_flags)
+
 
 class TracerMeta(type):
     def __new__(mcs, *args, **kwargs):
@@ -146,6 +342,15 @@ class Tracer(object):
             watch=(),
             watch_explode=(),
             depth=1,
+            sample_rate=None,
+            every=None,
+            max_calls=None,
+            max_lines=None,
+            max_bytes_per_second=None,
+            collapse_loops=None,
+            only_if=None,
+            on_exception=False,
+            buffer_size=1000,
     ):
         self.watch = [
             v if isinstance(v, BaseVariable) else CommonVariable(v)
@@ -154,19 +359,89 @@ class Tracer(object):
             v if isinstance(v, BaseVariable) else Exploding(v)
             for v in ensure_tuple(watch_explode)
         ]
-        self.frame_infos = ArgDefaultDict(FrameInfo)
+        self.frame_info_class = FrameInfo
+        # ThreadFrames for each thread, see _frames
+        self.thread_frames = threading.local()
         self.depth = depth
         assert self.depth >= 1
         self.target_codes = set()
+        # Frames running a with block, which are always removed by __exit__
         self.target_frames = set()
         self.variable_whitelist = None
 
-    def __call__(self, function):
-        if iscoroutinefunction(function):
-            raise NotImplementedError("coroutines are not supported, sorry!")
+        self.sample_rate = sample_rate
+        self.every = every
+        self.max_calls = max_calls
+        assert sample_rate is None or 0 <= sample_rate <= 1
+        assert every is None or every >= 1
+        assert max_calls is None or max_calls >= 0
+        self.sampling = not (sample_rate is None and every is None and max_calls is None)
+        # Totals for all the functions decorated by this tracer
+        self.traced_calls = 0
+        self.skipped_calls = 0
+        self.sampling_lock = threading.Lock()
+
+        self.max_lines = max_lines
+        self.max_bytes_per_second = max_bytes_per_second
+        self.limited = not (max_lines is None and max_bytes_per_second is None)
+        self.budget = threading.local()
+
+        self.collapse_loops = collapse_loops
+        assert collapse_loops is None or collapse_loops >= 1
+        # Tracks the frame whose loop is currently collapsed in each thread
+        self.collapsing = threading.local()
+
+        self.only_if = only_if
+        if only_if is not None:
+            self.only_if_code = compile(only_if, '<only_if>', 'eval')
+        self.on_exception = on_exception
+        self.buffer_size = buffer_size
+        assert buffer_size >= 1
+        self.conditional = only_if is not None or bool(on_exception)
+        # Maps the current asyncio task (or None) to its BufferedCall in each thread
+        self.buffered = threading.local()
+
+        self.profiler = None
+
+    def _set_profiler(self, profiler):
+        # Remove any previous wrapper around the trace method
+        self.__dict__.pop('trace', None)
+        self.profiler = profiler
+        if profiler is None:
+            self.frame_info_class = FrameInfo
+            return
+
+        self.trace = profiler.wrap_trace(self.trace)
+
+        class ProfiledFrameInfo(FrameInfo):
+            __slots__ = ()
+            update_variables = profiler.wrap('update_variables', FrameInfo.update_variables)
+            repr_value = staticmethod(profiler.wrap('repr', my_cheap_repr))
+
+        self.frame_info_class = profiler.wrap('frame_info', ProfiledFrameInfo)
 
+    def _frames(self):
+        """
+        Returns the ThreadFrames of the current thread.
+        """
+        try:
+            frames = self.thread_frames.frames
+        except AttributeError:
+            frames = self.thread_frames.frames = ThreadFrames(self.frame_info_class)
+        if frames.frame_infos.factory is not self.frame_info_class:
+            # Profiling was enabled or disabled since this thread last traced,
+            # so discard the FrameInfos of the previous class
+            frames.frame_infos = LRUCache('frame_infos', self.frame_info_class)
+        return frames
+
+    def __call__(self, function):
         self.target_codes.add(function.__code__)
 
+        if iscoroutinefunction(function) or isasyncgenfunction(function):
+            # Uses async syntax, so can't be imported in Python 2
+            from snoop.coroutines import async_wrapper
+            return async_wrapper(self, function)
+
         @functools.wraps(function)
         def simple_wrapper(*args, **kwargs):
             with self:
@@ -188,100 +463,466 @@ class Tracer(object):
                     method, incoming = gen.throw, e
 
         if inspect.isgeneratorfunction(function):
-            return generator_wrapper
+            wrapper = generator_wrapper
         else:
-            return simple_wrapper
+            wrapper = simple_wrapper
+
+        if not self.sampling:
+            return wrapper
+
+        should_trace = CallSampler(self)
+
+        @functools.wraps(function)
+        def sampling_wrapper(*args, **kwargs):
+            if should_trace():
+                return wrapper(*args, **kwargs)
+            else:
+                return function(*args, **kwargs)
+
+        return sampling_wrapper
 
     def __enter__(self, context=0):
+        frames = self._frames()
         if not self.config.enabled:
+            # Recorded so that __exit__ matches even if config.enabled changes in between
+            frames.blocks.append(False)
             return
 
-        self.config.thread_local.__dict__.setdefault('depth', -1)
+        if self.profiler is not self.config.profiler:
+            self._set_profiler(self.config.profiler)
+
+        thread_local = self.config.thread_local
+        thread_local.__dict__.setdefault('depth', -1)
+        thread_local.__dict__.setdefault('last_frame', None)
+        use_monitoring = self._use_monitoring()
+        if self.limited:
+            self._start_budget()
 
         calling_frame = sys._getframe(context + 1)
         if not self._is_internal_frame(calling_frame):
-            calling_frame.f_trace = self.trace
+            if use_monitoring:
+                monitoring_engine.watch_code(calling_frame.f_code)
+                monitoring_engine.set_frame_trace(calling_frame, self.trace)
+            else:
+                calling_frame.f_trace = self.trace
             self.target_frames.add(calling_frame)
-            self.config.last_frame = calling_frame
-            self.trace(calling_frame, 'enter', None)
+            thread_local.last_frame = calling_frame
+            try:
+                self.trace(calling_frame, 'enter', None)
+            except Exception:
+                # __exit__ won't be called
+                self.target_frames.discard(calling_frame)
+                if not frames.blocks:
+                    self._clear_frames(frames)
+                if self.limited:
+                    self._end_budget()
+                raise
+
+        frames.blocks.append(True)
+        if use_monitoring:
+            for code in self.target_codes:
+                monitoring_engine.watch_code(code)
+            monitoring_engine.push(self.trace, self.depth)
+            return
 
         stack = thread_global.__dict__.setdefault('original_trace_functions', [])
         stack.append(sys.gettrace())
         sys.settrace(self.trace)
 
     def __exit__(self, exc_type, exc_value, exc_traceback, context=0):
-        if not self.config.enabled:
+        frames = self._frames()
+        if not (frames.blocks and frames.blocks.pop()):
             return
 
-        previous_trace = thread_global.original_trace_functions.pop()
-        sys.settrace(previous_trace)
         calling_frame = sys._getframe(context + 1)
-        if not (PY34 and previous_trace is None):
-            calling_frame.f_trace = previous_trace
-        self.trace(calling_frame, 'exit', None)
-        self.target_frames.discard(calling_frame)
-        self.frame_infos.pop(calling_frame, None)
+        if self._use_monitoring():
+            previous_trace = monitoring_engine.pop(self.depth)
+            monitoring_engine.set_frame_trace(calling_frame, previous_trace)
+        else:
+            previous_trace = thread_global.original_trace_functions.pop()
+            sys.settrace(previous_trace)
+            if not (PY34 and previous_trace is None):
+                calling_frame.f_trace = previous_trace
+        try:
+            # The exception is passed on for Tracer(on_exception=True)
+            self.trace(calling_frame, 'exit', exc_type and (exc_type, exc_value, exc_traceback))
+        finally:
+            self.target_frames.discard(calling_frame)
+            frames.frame_infos.pop(calling_frame, None)
+            if not frames.blocks:
+                self._clear_frames(frames)
+            if self.limited:
+                self._end_budget()
+
+    def _clear_frames(self, frames):
+        """
+        Called when the outermost with block of this tracer in this thread ends,
+        by which point every frame should have been removed by its 'return' event.
+        Frames are only left over if that event never came, e.g. because the trace
+        function raised an exception (so Python stopped tracing) or another tool
+        replaced it with sys.settrace. Otherwise they and their locals would stay alive.
+        """
+        thread_local = self.config.thread_local
+        if frames.frame_distances:
+            # Each frame was counted in the depth when it was called
+            thread_local.depth = max(thread_local.depth - len(frames.frame_distances), -1)
+            frames.frame_distances.clear()
+        frames.frame_infos.clear()
+        if thread_local.depth == -1:
+            thread_local.last_frame = None
+
+    def _start_budget(self):
+        budget = self.budget
+        budget.nesting = getattr(budget, 'nesting', 0) + 1
+        if budget.nesting == 1:
+            budget.start_time = time.time()
+            budget.lines = 0
+            budget.bytes = 0
+            budget.exhausted = False
+            budget.suppressed_events = 0
+            budget.suppressed_lines = 0
+            budget.last_event = None
+
+    def _spend_budget(self, formatted, event):
+        budget = self.budget
+        budget.last_event = event
+        budget.lines += formatted.count(u'\n')
+        budget.bytes += len(formatted)
+        if self.max_lines is not None and budget.lines >= self.max_lines:
+            budget.exhausted = True
+        if self.max_bytes_per_second is not None:
+            # Allow a burst of max_bytes_per_second at the start
+            elapsed = max(time.time() - budget.start_time, 1)
+            if budget.bytes / elapsed >= self.max_bytes_per_second:
+                budget.exhausted = True
+
+    def _end_budget(self):
+        budget = self.budget
+        budget.nesting -= 1
+        if budget.nesting == 0:
+            self._output_suppressed()
+
+    def _output_suppressed(self):
+        budget = self.budget
+        if getattr(budget, 'exhausted', False) and budget.last_event:
+            self._output(
+                'format_suppressed',
+                budget.last_event,
+                budget.suppressed_events,
+                budget.suppressed_lines,
+            )
+        budget.last_event = None
 
-    def _is_internal_frame(self, frame):
-        return frame.f_code.co_filename.startswith(internal_directories)
+    def _use_monitoring(self):
+        return self.config.monitoring and monitoring_engine.activate()
 
-    def _is_traced_frame(self, frame):
-        return frame.f_code in self.target_codes or frame in self.target_frames
+    def _is_internal_frame(self, frame):
+        return bool(code_flags[frame.f_code] & INTERNAL)
 
     def trace(self, frame, event, arg):
-        if not self._is_traced_frame(frame):
-            if (
-                    self.depth == 1
-                    or self._is_internal_frame(frame)
-            ) and not is_comprehension_frame(frame):
+        if not (frame.f_code in self.target_codes or frame in self.target_frames):
+            flags = code_flags[frame.f_code]
+            if not flags & COMPREHENSION and (self.depth == 1 or flags & INTERNAL):
                 return None
-            else:
-                candidate = frame
-                i = 0
-                while True:
-                    if is_comprehension_frame(candidate):
-                        candidate = candidate.f_back
-                        continue
-                    i += 1
-                    if self._is_traced_frame(candidate):
-                        break
-                    candidate = candidate.f_back
-                    if i >= self.depth or candidate is None or self._is_internal_frame(candidate):
-                        return None
+            frames = self._frames()
+            if event == 'call':
+                parent_distance = frames.frame_distances.get(frame.f_back)
+                if parent_distance is None:
+                    return None
+                distance = parent_distance + (not flags & COMPREHENSION)
+                if distance >= self.depth:
+                    return None
+                frames.frame_distances[frame] = distance
+            elif frame not in frames.frame_distances:
+                return None
+        else:
+            frames = self._frames()
+            if event in ('call', 'enter'):
+                frames.frame_distances[frame] = 0
 
         thread_local = self.config.thread_local
-        frame_info = self.frame_infos[frame]
+        if self.limited and getattr(self.budget, 'exhausted', False):
+            budget = self.budget
+            budget.suppressed_events += 1
+            if event == 'line':
+                budget.suppressed_lines += 1
+            return self._skip_event(frame, event)
+
+        if self.collapse_loops is not None:
+            collapsing_frame = getattr(self.collapsing, 'frame', None)
+            if collapsing_frame is not None and collapsing_frame is not frame:
+                # Calls made from a collapsed loop iteration are hidden too
+                return self._skip_event(frame, event)
+
+        frame_info = frames.frame_infos[frame]
+        if (
+                event == 'exception'
+                and frame_info.generator_type in ('coroutine', 'async generator')
+                and is_await_stop(frame, arg[0])
+        ):
+            # An awaited coroutine or async iterator finished, which isn't an error
+            return self.trace
+
+        if self.collapse_loops is not None and self._collapse_loop_event(frame, frame_info, event):
+            return self._skip_event(frame, event)
+
+        trace_event = None
         if event in ('call', 'enter'):
             thread_local.depth += 1
-        elif self.config.last_frame and self.config.last_frame is not frame:
+        elif thread_local.last_frame and thread_local.last_frame is not frame:
             line_no = frame_info.last_line_no
             trace_event = Event(frame_info, event, arg, thread_local.depth, line_no=line_no)
-            line = self.config.formatter.format_line_only(trace_event)
-            self.config.write(line)
+            if self.conditional or self.config.recorder:
+                self._output('format_line_only', trace_event)
+            else:
+                line = self.config.formatter.format_line_only(trace_event)
+                self.config.write(line)
+                if self.limited:
+                    self._spend_budget(line, trace_event)
 
         if event == 'exception':
             frame_info.had_exception = True
 
-        self.config.last_frame = frame
+        thread_local.last_frame = frame
 
-        trace_event = Event(frame_info, event, arg, thread_local.depth)
+        if trace_event is None:
+            trace_event = Event(frame_info, event, arg, thread_local.depth)
+        else:
+            # Reuse the event from the line above, which has been written or copied
+            trace_event.line_no = frame.f_lineno
+            trace_event.formatted_prefix = None
         if not (frame.f_code.co_name == '<genexpr>' and event not in ('return', 'exception')):
             trace_event.variables = frame_info.update_variables(
                 self.watch,
                 self.config.watch_extras,
                 event,
                 self.variable_whitelist,
+                self.config.repr_fingerprint,
             )
 
         if event in ('return', 'exit'):
-            del self.frame_infos[frame]
+            del frames.frame_infos[frame]
+            frames.frame_distances.pop(frame, None)
             thread_local.depth -= 1
 
-        formatted = self.config.formatter.format(trace_event)
+        if self.conditional or self.config.recorder:
+            self._output('format', trace_event)
+        else:
+            formatted = self.config.formatter.format(trace_event)
+            self.config.write(formatted)
+            if self.limited:
+                self._spend_budget(formatted, trace_event)
+
+        if (
+                (self.config.demux or self.conditional or self.limited)
+                and event in ('return', 'exit')
+                # The call continues when the coroutine is resumed
+                and not (event == 'return' and trace_event.return_outcome == 'await')
+        ):
+            self._end_block(frames)
+
+        return self.trace
+
+    def _end_block(self, frames):
+        # Called when a call or with block traced by this tracer ends
+        if not frames.frame_distances:
+            # The outermost one of this tracer in this thread or task,
+            # which may still be inside a call traced by another tracer
+            if self.limited:
+                # Before the output of the call is written or discarded
+                self._output_suppressed()
+            if self.conditional:
+                # Discard the output of the call if the condition was never met
+                self._buffered_calls().pop(current_task(), None)
+        if self.config.demux and self.config.thread_local.depth == -1:
+            # The outermost traced call of the config
+            self.config.demux.end_block()
+
+    def _buffered_calls(self):
+        try:
+            return self.buffered.calls
+        except AttributeError:
+            self.buffered.calls = {}
+            return self.buffered.calls
+
+    def _output(self, method, event, *args):
+        """
+        Formats the event with the given formatter method and writes it,
+        unless it's kept unformatted for Tracer(only_if=...), Tracer(on_exception=True),
+        or the flight recorder.
+        """
+        if self.conditional:
+            calls = self._buffered_calls()
+            task = current_task()
+            call = calls.get(task)
+            if call is None:
+                call = calls[task] = BufferedCall(self.buffer_size)
+            if not call.triggered:
+                call.append(method, event, args)
+                if method == 'format' and self._condition_met(event):
+                    call.triggered = True
+                    self._write_buffered(call)
+                return
+
+        recorder = self.config.recorder
+        if recorder:
+            recorder.record(method, CapturedEvent(event), args)
+            return
+
+        formatted = getattr(self.config.formatter, method)(event, *args)
         self.config.write(formatted)
+        if self.limited:
+            self._spend_budget(formatted, event)
+
+    def _condition_met(self, event):
+        if self.only_if is not None:
+            frame = event.frame
+            try:
+                if eval(self.only_if_code, frame.f_globals, frame.f_locals):
+                    return True
+            except Exception:
+                # e.g. a NameError in a frame where the variable doesn't exist
+                pass
+
+        # Frames are forgotten before their 'return' or 'exit' event is output
+        return self.on_exception and not self._frames().frame_distances and (
+            # The outermost call of this tracer ended with an exception, or might have
+            event.event == 'return' and event.return_outcome in ('exception', 'unknown')
+            # or the with block did
+            or event.event == 'exit' and event.arg is not None
+        )
 
+    def _write_buffered(self, call):
+        formatter = self.config.formatter
+        recorder = self.config.recorder
+        events = list(call.events)
+        call.events.clear()
+        if call.dropped:
+            if recorder:
+                recorder.record('format_dropped', events[0][1], (call.dropped,))
+            else:
+                self.config.write(formatter.format_dropped(events[0][1], call.dropped))
+        for method, event, args in events:
+            if recorder:
+                recorder.record(method, event, args)
+                continue
+            formatted = getattr(formatter, method)(event, *args)
+            self.config.write(formatted)
+            if self.limited:
+                self._spend_budget(formatted, event)
+
+    def _skip_event(self, frame, event):
+        # Keep track of the bare minimum without formatting anything
+        thread_local = self.config.thread_local
+        if event in ('call', 'enter'):
+            thread_local.depth += 1
+        elif event in ('return', 'exit'):
+            frames = self._frames()
+            frames.frame_infos.pop(frame, None)
+            frames.frame_distances.pop(frame, None)
+            thread_local.depth -= 1
+            if self.config.demux or self.conditional or self.limited:
+                self._end_block(frames)
+        thread_local.last_frame = frame
         return self.trace
 
+    def _collapse_loop_event(self, frame, frame_info, event):
+        """
+        Keeps track of loops in the frame and returns True if the event
+        is part of a collapsed loop iteration, so it shouldn't be shown.
+        """
+        if frame_info.comprehension_type:
+            return False
+
+        loops = frame_info.loops
+        line_no = frame.f_lineno
+
+        if event == 'line':
+            # Leave loops that have finished
+            while loops and not (loops[-1].start <= line_no <= loops[-1].end):
+                self._write_loop_summary(frame_info, loops.pop())
+
+            loop_node = frame_info.source.loops[line_no]
+            if loop_node is not None:
+                if loops and loops[-1].node is loop_node:
+                    loops[-1].iterations += 1
+                else:
+                    loops.append(Loop(loop_node))
+        elif event in ('return', 'exit'):
+            while loops:
+                self._write_loop_summary(frame_info, loops.pop())
+
+        collapsed_loop = None
+        for loop in loops:
+            if loop.iterations > self.collapse_loops:
+                collapsed_loop = loop
+                break
+
+        if collapsed_loop is None or event != 'line':
+            # Show the event, and summarise the iterations before it
+            if collapsed_loop:
+                self._write_loop_summary(frame_info, collapsed_loop)
+            self.collapsing.frame = None
+            return False
+
+        f_locals = frame.f_locals
+        whitelist = self.variable_whitelist
+        for name in f_locals:
+            if (
+                    name not in frame_info.local_reprs
+                    and (whitelist is None or name in whitelist)
+                    and not name.startswith(pp_name_prefix)
+            ):
+                # Show iterations where a new variable appears
+                self._write_loop_summary(frame_info, collapsed_loop)
+                self.collapsing.frame = None
+                return False
+
+        if frame_info.last_line_no == collapsed_loop.start and (
+                line_no != collapsed_loop.start
+                # The body is on the same line, as in `for x in y: f(x)`
+                or collapsed_loop.end == collapsed_loop.start
+        ):
+            # Entered the body of the loop
+            collapsed_loop.record_iteration(f_locals)
+
+        frame_info.last_line_no = line_no
+        self.collapsing.frame = frame
+        return True
+
+    def _write_loop_summary(self, frame_info, loop):
+        if not loop.skipped:
+            return
+        values = [
+            (name, first, my_cheap_repr(last))
+            for name, first, last in zip(loop.target_names, loop.first_values, loop.last_values)
+        ]
+        trace_event = Event(frame_info, 'line', None, self.config.thread_local.depth)
+
+        # Show the other variables that changed in the collapsed iterations,
+        # without affecting the line of the event being traced
+        last_line_no = frame_info.last_line_no
+        changed = [
+            (name, value)
+            for name, value in frame_info.update_variables(
+                self.watch,
+                self.config.watch_extras,
+                'line',
+                self.variable_whitelist,
+                self.config.repr_fingerprint,
+            )
+            if name not in loop.target_names
+        ]
+        frame_info.last_line_no = last_line_no
+
+        if self.conditional or self.config.recorder:
+            self._output('format_loop_summary', trace_event, loop, loop.skipped, values, changed)
+        else:
+            self.config.write(self.config.formatter.format_loop_summary(
+                trace_event, loop, loop.skipped, values, changed))
+        loop.skipped = 0
+        loop.first_values = loop.last_values = None
+
     @staticmethod
     def load_ipython_extension(ipython_shell):
         from snoop.ipython import SnoopMagics
@@ -1,7 +1,10 @@
 import ast
+import gc
 import inspect
+import opcode
 import os
 import sys
+import weakref
 from itertools import chain
 
 import six
@@ -90,6 +93,39 @@ def my_cheap_repr(x):
     return cheap_repr(x, target_length=REPR_TARGET_LENGTH)
 
 
+immutable_types = set(
+    (type(None), bool, int, float, complex, type(six.moves.range(0)))
+    + six.string_types + six.integer_types + (six.text_type, six.binary_type)
+)
+
+
+# Fingerprint of values whose repr can never change, see configuration.immutable_fingerprint.
+# A unique object so that it can't be confused with a fingerprint returned by users.
+IMMUTABLE = object()
+
+
+def is_immutable(x, max_items=100):
+    """
+    Returns True if x is known to be deeply immutable, e.g. an int
+    or a tuple of strings, so that its repr can never change.
+    Containers with more than max_items items in total
+    are assumed to be mutable to keep this cheap.
+    """
+    stack = [x]
+    while stack:
+        x = stack.pop()
+        cls = type(x)
+        if cls in immutable_types:
+            continue
+        if cls not in (tuple, frozenset):
+            return False
+        max_items -= len(x)
+        if max_items < 0:
+            return False
+        stack.extend(x)
+    return True
+
+
 class ArgDefaultDict(dict):
     def __init__(self, factory):
         super(ArgDefaultDict, self).__init__()
@@ -100,6 +136,167 @@ class ArgDefaultDict(dict):
         return result
 
 
+# Default maximum number of entries of each kind of LRUCache, see set_cache_limit
+cache_limits = {
+    # Source objects, including their syntax trees and highlighted lines
+    'sources': 100,
+    # Nodes found by executing, for pp and exceptions
+    'executing': 1000,
+    'code_flags': 10000,
+    'code_var_ranks': 10000,
+    'formatters': 10,
+    # Line numbers of bytecode offsets, used with sys.monitoring
+    'line_tables': 1000,
+    # Per Tracer and thread. Entries are normally removed when the frame returns
+    'frame_infos': 10000,
+}
+
+# All instances of LRUCache, by id
+all_caches = weakref.WeakValueDictionary()
+
+# Functions wrapped with functools.lru_cache, by name, for cache_stats
+lru_cached_functions = {}
+
+
+class LRUCache(dict):
+    """
+    Dict with at most about `maxsize` entries, evicting the least recently used,
+    which creates missing values with factory(key) like ArgDefaultDict if there is one.
+    The size limit is taken from cache_limits[name].
+
+    To keep looking up existing entries as fast as with a plain dict,
+    recency is tracked approximately in two generations: the dict itself holds
+    new and recently used entries, and when it's full it replaces the old generation.
+    Entries from the old generation are moved back when they're used,
+    so only entries unused for a whole generation are evicted.
+    Methods other than the ones below only see the newer generation.
+    """
+
+    def __init__(self, name, factory=None):
+        super(LRUCache, self).__init__()
+        self.name = name
+        self.maxsize = cache_limits[name]
+        self.factory = factory
+        self.old = {}
+        self.misses = 0
+        self.evictions = 0
+        all_caches[id(self)] = self
+
+    def __missing__(self, key):
+        try:
+            value = self.old.pop(key)
+        except KeyError:
+            self.misses += 1
+            if self.factory is None:
+                raise KeyError(key)
+            value = self.factory(key)
+        self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        # Each generation holds at most half of maxsize
+        if dict.__len__(self) >= self.maxsize // 2 and not dict.__contains__(self, key):
+            self.evictions += len(self.old)
+            self.old = dict(self)
+            dict.clear(self)
+        dict.__setitem__(self, key, value)
+
+    def resize(self, maxsize):
+        """
+        Changes maxsize, evicting only the old generation, so that entries
+        in use (e.g. FrameInfos of running frames) are kept and moved back when used.
+        """
+        self.maxsize = maxsize
+        if len(self) > maxsize:
+            self.evictions += len(self.old)
+            self.old = {}
+            if dict.__len__(self) > maxsize // 2:
+                self.old = dict(self)
+                dict.clear(self)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.old
+
+    def __len__(self):
+        return dict.__len__(self) + len(self.old)
+
+    def __delitem__(self, key):
+        try:
+            dict.__delitem__(self, key)
+        except KeyError:
+            del self.old[key]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        self.misses += 1
+        return default
+
+    def pop(self, key, *default):
+        try:
+            return dict.pop(self, key)
+        except KeyError:
+            return self.old.pop(key, *default)
+
+    def clear(self):
+        dict.clear(self)
+        self.old.clear()
+
+    def stats(self):
+        return dict(
+            size=len(self),
+            maxsize=self.maxsize,
+            misses=self.misses,
+            evictions=self.evictions,
+        )
+
+
+def cache_stats():
+    """
+    Returns a dict describing each kind of cache that snoop uses, e.g.
+    {'sources': {'caches': 1, 'size': 3, 'maxsize': 100, 'misses': 5, 'evictions': 0}, ...}.
+    Each Tracer has its own 'frame_infos' cache in each thread, so the statistics of all
+    existing ones are added together, except maxsize which is the limit of each one.
+    """
+    result = {
+        name: dict(caches=0, size=0, maxsize=maxsize, misses=0, evictions=0)
+        for name, maxsize in cache_limits.items()
+    }
+    for cache in list(all_caches.values()):
+        totals = result[cache.name]
+        totals['caches'] += 1
+        for key, value in cache.stats().items():
+            if key == 'maxsize':
+                totals[key] = value
+            else:
+                totals[key] += value
+
+    for name, function in lru_cached_functions.items():
+        info = function.cache_info()
+        result[name] = dict(
+            caches=1,
+            size=info.currsize,
+            maxsize=info.maxsize,
+            misses=info.misses,
+            # Entries are only removed by eviction
+            evictions=info.misses - info.currsize,
+        )
+    return result
+
+
+def set_cache_limit(name, maxsize):
+    """
+    Changes the maximum number of entries in caches of the given kind,
+    i.e. a key of cache_limits, including existing caches.
+    """
+    assert maxsize >= 2
+    cache_limits[name]  # Raises KeyError for unknown names
+    cache_limits[name] = maxsize
+    for cache in list(all_caches.values()):
+        if cache.name == name:
+            cache.resize(maxsize)
+
+
 def optional_numeric_label(i, lst):
     if len(lst) == 1:
         return ''
@@ -125,6 +322,96 @@ except AttributeError:
     def iscoroutinefunction(_):
         return False
 
+try:
+    isasyncgenfunction = inspect.isasyncgenfunction
+except AttributeError:
+    def isasyncgenfunction(_):
+        return False
+
+
+# Code flags of functions which can be suspended and resumed.
+# Those that don't exist in this version of Python are 0 and never match.
+generator_flags = [
+    (getattr(inspect, 'CO_COROUTINE', 0), 'coroutine'),
+    (getattr(inspect, 'CO_ASYNC_GENERATOR', 0), 'async generator'),
+    (inspect.CO_GENERATOR, 'generator'),
+]
+
+
+def get_generator_type(code):
+    for flag, generator_type in generator_flags:
+        if code.co_flags & flag:
+            return generator_type
+    return ''
+
+
+await_stop_exceptions = tuple(
+    getattr(six.moves.builtins, name)
+    for name in ['StopIteration', 'StopAsyncIteration']
+    if hasattr(six.moves.builtins, name)
+)
+
+
+def is_await_stop(frame, exc_type):
+    """
+    Returns True if an exception in a coroutine frame is the StopIteration
+    or StopAsyncIteration that ends an `await` or `async for` internally,
+    rather than one raised by the code.
+    """
+    return (
+            issubclass(exc_type, await_stop_exceptions)
+            # The instruction that delegates to the awaited object,
+            # depending on the Python version
+            and opcode.opname[frame.f_code.co_code[frame.f_lasti]] in ('YIELD_FROM', 'SEND', 'END_SEND')
+    )
+
+
+def unwrap_async_gen_value(value):
+    """
+    Values yielded by async generators are seen by trace functions wrapped
+    in an internal type which can't be unwrapped directly.
+    The garbage collector can still find the wrapped value.
+    """
+    if type(value).__name__ == 'async_generator_wrapped_value':
+        referents = gc.get_referents(value)
+        if len(referents) == 1:
+            return referents[0]
+    return value
+
+
+def current_task():
+    """
+    Returns the asyncio task running in this thread, or None.
+    """
+    asyncio = sys.modules.get('asyncio')
+    if asyncio is None:
+        return None
+
+    # Unlike the public functions, this doesn't raise or create a loop
+    get_running_loop = getattr(asyncio.events, '_get_running_loop', None)
+    loop = get_running_loop and get_running_loop()
+    if loop is None:
+        return None
+
+    get_current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+    return get_current_task(loop)
+
+
+def task_name(task):
+    if hasattr(task, 'get_name'):
+        return task.get_name()
+    # Tasks don't have names before Python 3.8
+    return u'Task at {:#x}'.format(id(task))
+
+
+def current_task_name():
+    """
+    Returns the name of the asyncio task running in this thread, or None.
+    """
+    task = current_task()
+    return task and task_name(task)
+
+
 try:
     try_statement = ast.Try
 except AttributeError:
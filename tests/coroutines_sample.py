@@ -0,0 +1,41 @@
+# Uses async syntax, so only imported by tests in Python 3.7+
+
+import asyncio
+
+
+async def helper(x):
+    await asyncio.sleep(0)
+    return x * 2
+
+
+async def work(n):
+    total = 0
+    for i in range(n):
+        total += await helper(i)
+    return total
+
+
+async def untraced():
+    for i in range(3):
+        await asyncio.sleep(0)
+
+
+async def numbers(n):
+    for i in range(n):
+        await asyncio.sleep(0)
+        yield [i]
+
+
+def main(snoop):
+    traced_work = snoop(depth=2)(work)
+    traced_numbers = snoop(numbers)
+
+    async def run():
+        results = await asyncio.gather(traced_work(2), untraced())
+        return results[0], [x async for x in traced_numbers(2)]
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
@@ -1,13 +1,14 @@
 from __future__ import print_function
 
 import io
+import json
 import os
 import re
 import sys
 import traceback
 from importlib import import_module
 from tempfile import mkstemp
-from threading import current_thread
+from threading import Event, Thread, current_thread
 
 import pytest
 import six
@@ -19,11 +20,17 @@ from littleutils import file_to_string, group_by_key_func, string_to_file
 sys.modules['prettyprinter'] = {}
 sys.modules['pprintpp'] = {}
 
-from snoop import formatting, install, spy
-from snoop.configuration import Config
+from snoop import formatting, install, monitoring, spy
+from snoop import tracer as tracer_module
+from snoop.configuration import Config, async_writers, length_fingerprint
+from snoop.formatting import StructuredFormatter
 from snoop.pp_module import is_deep_arg
-from snoop.utils import (NO_ASTTOKENS, NO_BIRDSEYE, PYPY, needs_parentheses,
-                         truncate_list, truncate_string)
+from snoop.render import main as render_main
+from snoop.source_cache import source_cache
+from snoop.tracer import Tracer
+from snoop.utils import (NO_ASTTOKENS, NO_BIRDSEYE, PYPY, LRUCache,
+                         is_immutable, needs_parentheses, truncate_list,
+                         truncate_string)
 
 formatting._get_filename = lambda _: "/path/to_file.py"
 
@@ -63,7 +70,7 @@ def sample_traceback():
     sys.stderr.write(tb)
 
 
-def assert_sample_output(module_name):
+def sample_output(module_name):
     module = import_module('tests.samples.' + module_name)
     old = sys.stderr
 
@@ -88,6 +95,11 @@ def assert_sample_output(module_name):
     normalised = normalised.replace('<tuple_iterator', '<tupleiterator')
     normalised = normalised.replace('<sequenceiterator', '<tupleiterator')
     normalised = normalised.replace(str(current_thread().ident), '123456789')
+    return normalised
+
+
+def assert_sample_output(module_name):
+    normalised = sample_output(module_name)
 
     result_filename = os.path.join(
         tests_dir,
@@ -139,6 +151,46 @@ def test_sample(module_name):
     assert_sample_output(module_name)
 
 
+@pytest.mark.skipif(not monitoring.available, reason="sys.monitoring requires Python 3.12+")
+@pytest.mark.parametrize("module_name", generate_test_samples())
+def test_monitoring_sample(module_name, monkeypatch):
+    if module_name == 'generator':
+        pytest.skip("checks sys.gettrace()")
+
+    sample_output(module_name)  # warm up state such as column widths
+    expected = sample_output(module_name)
+    monkeypatch.setattr(Tracer, '_use_monitoring', lambda self: monitoring.engine.activate())
+    assert sample_output(module_name) == expected
+
+
+@pytest.mark.skipif(not monitoring.available, reason="sys.monitoring requires Python 3.12+")
+def test_monitoring_events_disabled_after_tracing():
+    string_io = io.StringIO()
+    config = Config(out=string_io, monitoring=True)
+
+    def bar(x):
+        return x + 1
+
+    @config.snoop(depth=2)
+    def foo(x):
+        try:
+            raise ValueError(x)
+        except ValueError:
+            return bar(x)
+
+    assert foo(1) == 2
+    assert u'<locals>.bar in File' in string_io.getvalue()
+
+    engine = monitoring.engine
+    tool_id = engine.tool_id
+    assert sys.monitoring.get_tool(tool_id) == 'snoop'
+    assert sys.monitoring.get_events(tool_id) == 0
+    for code in (foo.__wrapped__.__code__, bar.__code__):
+        assert sys.monitoring.get_local_events(tool_id, code) == 0
+    assert not engine.watched_codes
+    assert engine.line_tables.maxsize == 1000
+
+
 @pytest.mark.order(2)  # Execute after all test_samples have run.
 def test_compare_versions():
     out = [""]
@@ -237,6 +289,947 @@ def test_overwrite():
     assert output == u'doo be doo'
 
 
+def test_file_buffering():
+    _, path = mkstemp()
+    config = Config(out=path, overwrite=True, file_buffer_size=10, file_flush_interval=999)
+    writer = config.write.__self__
+
+    config.write(u'abc')
+    assert file_to_string(path) == u''
+    config.write(u'defghijk')
+    assert file_to_string(path) == u'abcdefghijk'
+
+    # Simulate log rotation
+    os.rename(path, path + '.1')
+    config.write(u'lmn')
+    writer.flush()
+    assert file_to_string(path + '.1') == u'abcdefghijk'
+    assert file_to_string(path) == u'lmn'
+
+    writer.file.close()
+    os.remove(path + '.1')
+
+
+def test_async_write():
+    string_io = io.StringIO()
+    config = Config(out=string_io, async_write=True)
+    for i in range(100):
+        config.write(u'{}\n'.format(i))
+    config.async_writer.flush()
+    assert string_io.getvalue() == u''.join(u'{}\n'.format(i) for i in range(100))
+    config.async_writer.close()
+    assert config.async_writer not in async_writers
+
+    # Unused writers can be garbage collected
+    import gc
+    count = len(async_writers)
+    for _ in range(10):
+        Config(out=string_io, async_write=True)
+    gc.collect()
+    assert len(async_writers) == count
+
+
+def test_async_write_to_buffered_file(tmpdir):
+    path = tmpdir.join('snoop.log')
+    config = Config(out=str(path), async_write=True, file_buffer_size=10 ** 6, file_flush_interval=1000)
+    lines = [u'{}\n'.format(i) for i in range(20000)]
+    for line in lines:
+        config.write(line)
+    # As at exit, when FileWriter's own atexit handler may already have run
+    config.async_writer.close()
+    assert path.read_text('utf8') == u''.join(lines)
+    config.write(u'after close\n')
+    assert path.read_text('utf8').endswith(u'19999\nafter close\n')
+
+
+@pytest.mark.parametrize("overflow,expected", [
+    ('drop_newest', u'0[snoop] 2 writes dropped because the output queue was full\n12'),
+    ('drop_oldest', u'0[snoop] 2 writes dropped because the output queue was full\n34'),
+])
+def test_async_write_overflow(overflow, expected):
+    written = []
+    started = Event()
+    release = Event()
+
+    def write(s):
+        started.set()
+        release.wait()
+        written.append(s)
+
+    config = Config(out=write, async_write=True, async_queue_size=2, async_overflow=overflow)
+    config.write(u'0')
+    started.wait()
+    for i in range(1, 5):
+        config.write(six.text_type(i))
+    release.set()
+    config.async_writer.flush()
+    assert u''.join(written) == expected
+
+
+def test_is_immutable():
+    assert is_immutable(1)
+    assert is_immutable(u'x')
+    assert is_immutable(None)
+    assert is_immutable((1, (u'a', frozenset([2.5]))))
+    # A slice can hold mutable objects
+    assert not is_immutable(slice([1], None))
+    assert not is_immutable([])
+    assert not is_immutable((1, []))
+    assert not is_immutable(tuple(range(101)))
+    assert not is_immutable(Foo())
+
+
+def test_repr_reused_for_immutable_values(monkeypatch):
+    reprs = []
+
+    def my_cheap_repr(x):
+        reprs.append(x)
+        return cheap_repr(x)
+
+    monkeypatch.setattr(tracer_module, 'my_cheap_repr', my_cheap_repr)
+    config = Config(out=io.StringIO())
+
+    @config.snoop
+    def foo():
+        x = (1, u'unique string')
+        y = [1]
+        y = [2]
+        return x, y
+
+    foo()
+    assert [r for r in reprs if isinstance(r, tuple) and r[1] == u'unique string'] == [(1, u'unique string')]
+    assert len([r for r in reprs if isinstance(r, list)]) == 3
+
+
+def test_length_fingerprint():
+    string_io = io.StringIO()
+    config = Config(out=string_io, repr_fingerprint=length_fingerprint)
+
+    @config.snoop
+    def foo():
+        lst = [1, 2]
+        lst[0] = 3
+        lst.append(4)
+
+    foo()
+    output = string_io.getvalue()
+    assert u'lst = [1, 2]' in output
+    assert u'lst = [3, 2]' not in output
+    assert u'lst = [3, 2, 4]' in output
+
+
+def test_sampling():
+    string_io = io.StringIO()
+    config = Config(out=string_io)
+    tracer = config.snoop(every=3, max_calls=2)
+
+    @tracer
+    def foo(x):
+        return x
+
+    @tracer
+    def gen(x):
+        yield x
+
+    assert [foo(i) for i in range(5)] == list(range(5))
+    assert list(gen(5)) == [5]
+    assert list(gen(6)) == [6]
+    # Each function is counted separately,
+    # and calls after max_calls was reached aren't counted
+    assert tracer.traced_calls == 3
+    assert tracer.skipped_calls == 3
+    output = string_io.getvalue()
+    assert output.count(u'>>> Call to') == 2
+    assert output.count(u'>>> Start generator') == 1
+    assert u'x = 0' in output
+    assert u'x = 3' in output
+    assert u'x = 5' in output
+    assert u'x = 6' not in output
+
+    # Counts are exact when calls come from several threads
+    tracer = config.snoop(every=10)
+    bar = tracer(lambda: None)
+    threads = [Thread(target=lambda: [bar() for _ in range(100)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert tracer.traced_calls == 40
+    assert tracer.skipped_calls == 360
+
+    tracer = config.snoop(sample_rate=0)
+    assert tracer(foo)(1) == 1
+    assert tracer.traced_calls == 0
+    assert tracer.skipped_calls == 1
+
+
+def test_max_lines():
+    string_io = io.StringIO()
+    config = Config(out=string_io, columns=())
+
+    @config.snoop(max_lines=10)
+    def foo():
+        total = 0
+        for i in range(100):
+            total += i
+        return total
+
+    assert foo() == 4950
+    lines = string_io.getvalue().splitlines()
+    assert len(lines) == 12
+    assert lines[-1].strip() == u'... Output limit reached, skipped 198 events (197 lines)'
+
+    # The limit applies to each call separately
+    foo()
+    assert len(string_io.getvalue().splitlines()) == 24
+
+    # The last line goes with the rest of the output of the call
+    string_io = io.StringIO()
+    config = Config(out=string_io, columns=(), demux=True)
+
+    @config.snoop(max_lines=10, only_if='i > 50')
+    def bar(n):
+        total = 0
+        for i in range(n):
+            total += i
+        return total
+
+    assert bar(10) == 45
+    assert string_io.getvalue() == u''
+    assert bar(100) == 4950
+    lines = string_io.getvalue().splitlines()
+    assert lines[-1].strip().startswith(u'... Output limit reached, skipped')
+    assert sum(u'Output limit reached' in line for line in lines) == 1
+    bar(10)
+    assert string_io.getvalue().splitlines() == lines
+
+
+def test_collapse_loops():
+    string_io = io.StringIO()
+    config = Config(out=string_io, columns=())
+
+    @config.snoop(collapse_loops=2)
+    def foo():
+        total = 0
+        for i in range(100):
+            total += i
+            if i == 50:
+                found = i
+        else:
+            digits = len(str(total))
+        return total, found, digits
+
+    assert foo() == (4950, 50, 4)
+    lines = [line.strip() for line in string_io.getvalue().splitlines()]
+    # The summary is followed by the other variables that changed
+    start = lines.index(u'.............. ... 49 more iterations, i = 2 ... 50')
+    assert lines[start + 1:start + 3] == [u'.............. total = 1275', u'.............. found = 50']
+    start = lines.index(u'.............. ... 49 more iterations, i = 51 ... 99')
+    assert lines[start + 1] == u'.............. total = 4950'
+    assert lines.count(u'.............. total = 4950') == 1
+    # The else block isn't part of the loop
+    assert lines[start + 2].endswith(u'|             digits = len(str(total))')
+    assert lines[start + 3] == u'.................. digits = 4'
+    assert lines[-1].endswith(u'foo: (4950, 50, 4)')
+    assert len(lines) < 40
+
+    # A loop whose body is on the same line
+    string_io.truncate(0)
+    string_io.seek(0)
+
+    @config.snoop(collapse_loops=2)
+    def bar():
+        total = 0
+        for i in range(100): total += i
+        return total
+
+    assert bar() == 4950
+    lines = [line.strip() for line in string_io.getvalue().splitlines()]
+    assert sum(line.endswith(u'. ... 99 more iterations, i = 1 ... 99') for line in lines) == 1
+    assert sum(line.endswith(u'. total = 4950') for line in lines) == 1
+    assert len(lines) < 15
+
+    # Loops can't be found without the source, so nothing is collapsed
+    string_io.truncate(0)
+    string_io.seek(0)
+    namespace = {}
+    exec('def bar():\n    for i in range(5):\n        pass\n', namespace)
+    config.snoop(collapse_loops=2)(namespace['bar'])()
+    output = string_io.getvalue()
+    assert u'SOURCE IS UNAVAILABLE' in output
+    assert all(u'i = {}'.format(i) in output for i in range(5))
+    assert u'more iterations' not in output
+
+
+def test_structured_formatter():
+    string_io = io.StringIO()
+    config = Config(out=string_io, formatter_class=StructuredFormatter)
+
+    def bar(x):
+        raise ValueError(x)
+
+    @config.snoop(depth=2)
+    def foo(n):
+        total = 0
+        for i in range(n):
+            total += i
+        try:
+            bar(total)
+        except ValueError:
+            pass
+        return total
+
+    foo(3)
+    foo(2)
+    records = [json.loads(line) for line in string_io.getvalue().splitlines()]
+    assert [r['type'] for r in records].count('file') == 1
+    assert [r['type'] for r in records].count('code') == 2
+    file_record = records[0]
+    assert file_record['type'] == 'file'
+    assert 'def test_structured_formatter' in file_record['source']
+    codes = {r['id']: r for r in records if r['type'] == 'code'}
+    assert {c['name'] for c in codes.values()} == {'foo', 'bar'}
+    assert all(c['file'] == file_record['id'] for c in codes.values())
+
+    events = [r for r in records if r['type'] == 'event']
+    foo_id = events[0]['code']
+    assert codes[foo_id]['qualname'].endswith('foo')
+    assert events[0]['event'] == 'call'
+    assert ['n', '3'] in events[0]['vars']
+    assert events[0]['thread'] == current_thread().name
+    assert ['total', '3'] in [v for e in events for v in e.get('vars', [])]
+
+    exceptions = [e for e in events if e['event'] == 'exception']
+    assert exceptions[0]['exception'] == ['ValueError: 3']
+    assert exceptions[1]['node'] == ['calling', 'bar(total)']
+
+    returns = [e for e in events if e['event'] == 'return']
+    assert [(r['outcome'], r.get('value'), r['depth']) for r in returns] == [
+        ('exception', None, 1),
+        ('return', '3', 0),
+        ('exception', None, 1),
+        ('return', '1', 0),
+    ]
+
+    # Records describing files and code objects could end up after the records using them
+    with pytest.raises(ValueError):
+        Config(out=string_io, formatter_class=StructuredFormatter, demux=True)
+    with pytest.raises(ValueError):
+        Config(out=string_io, formatter_class=StructuredFormatter,
+               async_write=True, async_overflow='drop_oldest')
+    Config(out=string_io, formatter_class=StructuredFormatter, async_write=True).async_writer.close()
+
+
+def test_render(capsys):
+    def run(config):
+        def bar(x):
+            raise ValueError(x)
+
+        def gen():
+            yield 1
+            yield 2
+
+        @config.snoop(depth=2, collapse_loops=2)
+        def foo(n):
+            total = 0
+            for i in range(n):
+                total += i
+            try:
+                bar(total)
+            except ValueError:
+                pass
+            config.pp(total, [x * 2 for x in range(3)])
+            list(gen())
+            return total
+
+        foo(10)
+
+    _, path = mkstemp(suffix='.jsonl')
+    try:
+        run(Config(out=path, formatter_class=StructuredFormatter))
+        expected = io.StringIO()
+        run(Config(out=expected, columns='thread function', color=False))
+
+        render_main([path, '--columns', 'thread function', '--no-color'])
+    finally:
+        os.remove(path)
+
+    def normalise(output):
+        return re.sub(r'0x[0-9a-f]+', '0xABC', output)
+
+    output = capsys.readouterr().out
+    assert 'Start generator' in output
+    assert normalise(output) == normalise(expected.getvalue())
+
+
+def test_source_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(source_cache, 'directory', None)
+    Config(source_cache_dir=tmpdir)
+    assert source_cache.directory == str(tmpdir)
+
+    filename = str(tmpdir.join('cached.py'))
+    text = u'def foo(x):\n    return x + 1\n'
+    style = formatting.NeutralMonokaiStyle
+    highlighted = formatting.Source(filename, text.splitlines(True)).highlighted[style]
+    assert u'\x1b[' in highlighted[0]
+    assert len(tmpdir.listdir(lambda p: p.ext == '.json')) == 1
+
+    def fail(*_):
+        raise AssertionError("Should have been cached")
+
+    # A new process would create a new Source and find the cached lines
+    with monkeypatch.context() as m:
+        m.setattr(formatting, 'raw_highlight', fail)
+        source = formatting.Source(filename, text.splitlines(True))
+        assert source.highlighted[style] == highlighted
+
+    # Changed contents mean the entry is stale
+    source = formatting.Source(filename, (text + u'foo(2)\n').splitlines(True))
+    assert len(source.highlighted[style]) == 3
+
+
+def test_lazy_highlighting():
+    text = u"""\
+import os
+
+x = \'\'\'
+def not_code():
+    pass
+\'\'\'
+
+
+def foo(y):
+    z = [
+        y,  # comment
+        "string",
+    ]
+    return z
+
+
+def bar():
+    return \'\'\'
+    still a string
+    \'\'\'
+"""
+    style = formatting.NeutralMonokaiStyle
+    source = formatting.Source('lazy.py', text.splitlines(True))
+    lines = source.highlighted[style]
+    assert isinstance(lines, formatting.HighlightedLines)
+
+    # Only the statement containing the line is highlighted
+    assert u'not_code' in lines[3]
+    assert sorted(lines.highlighted) == [2, 3, 4, 5, 6, 7]
+
+    expected = formatting.raw_highlight(text, style).splitlines()
+    assert len(lines) == len(expected)
+    for i in reversed(range(len(expected))):
+        assert lines[i] == expected[i]
+    with pytest.raises(IndexError):
+        lines[len(expected)]
+
+
+def test_repr_highlighter():
+    style = formatting.NeutralMonokaiStyle
+    highlighter = formatting.ReprHighlighter(style)
+    for code in [
+        u"[1, 2, 3, ..., 98, 99, 100]",
+        u"{'a': -1.5, 'b': None, \"c\": True}",
+        u"<Foo object at 0x7f0012345678>",
+        u"Point(x=1, y=len)",
+        u"''",
+    ]:
+        assert highlighter.tokens(code) is not None
+        assert highlighter(code) == formatting.raw_highlight(code, style)
+
+    assert highlighter.enabled
+    for code in [
+        u"<class 'int'>",
+        u"'escaped\\n'",
+        u"'%s'",
+        u"b'bytes'",
+        u"1e10",
+        u"x <= y",
+        u"multi\nline",
+        u" leading space",
+        u".5",
+        u"-.0",
+        u"x=.99",
+        u"{}.1",
+        u"(x := 1)",
+    ]:
+        assert highlighter.tokens(code) is None
+        assert highlighter(code) == formatting.raw_highlight(code, style)
+
+
+def test_columns_computed_once_per_event():
+    events = []
+
+    def column(event):
+        events.append(event)
+        return 'col'
+
+    string_io = io.StringIO()
+    config = Config(out=string_io, columns=[column, 'elapsed', 'thread'])
+    config.pp(1, 2, 3)
+    assert len(events) == 1
+    lines = string_io.getvalue().splitlines()
+    assert len(lines) == 4
+    for line in lines:
+        assert re.match(r'col \d+\.\d{6} MainThread ', line)
+
+
+def test_profile_overhead():
+    string_io = io.StringIO()
+    config = Config(out=string_io, profile_overhead=True)
+
+    def untraced(x):
+        return x * 2
+
+    @config.snoop
+    def foo(n):
+        total = 0
+        for i in range(n):
+            total += untraced(i)
+        return total
+
+    assert foo(3) == 6
+    config.pp(1)
+    profiler = config.profiler
+    assert profiler.counts['frame_info'] == 1
+    # Also includes calls to snoop's own functions, e.g. Tracer.__exit__
+    assert profiler.rejected >= 3
+    assert profiler.counts['repr'] > 0
+    # Includes the 'line' events for returning to foo
+    assert profiler.counts['format'] == profiler.counts['write'] > profiler.counts['update_variables']
+    for category in ['trace', 'frame_info', 'update_variables', 'repr', 'format', 'write']:
+        assert profiler.times[category] > 0
+
+    report = profiler.report()
+    assert report.startswith(u'snoop overhead:\n')
+    assert u'for untraced frames)' in report
+    assert len(report.splitlines()) == 7
+    assert report not in string_io.getvalue()
+
+    profiler.reset()
+    assert profiler.counts['trace'] == profiler.rejected == 0
+    assert Config().profiler is None
+
+
+def test_profile_overhead_other_threads():
+    config = Config(out=io.StringIO(), profile_overhead=True)
+    profiler = config.profiler
+    config.profiler = None
+
+    @config.snoop
+    def foo():
+        return 1
+
+    traced = Event()
+    profiled = Event()
+
+    def other():
+        foo()
+        traced.set()
+        profiled.wait()
+        foo()
+
+    thread = Thread(target=other)
+    thread.start()
+    traced.wait()
+    # Profiling starts in the main thread, after the other thread has traced
+    config.profiler = profiler
+    foo()
+    profiled.set()
+    thread.join()
+    assert profiler.counts['frame_info'] == 2
+
+
+def test_code_flags():
+    code_flags = tracer_module.code_flags
+    assert code_flags[Tracer.trace.__code__] == tracer_module.INTERNAL
+    assert code_flags[test_code_flags.__code__] == 0
+
+    code = compile('[x for x in y]', __file__, 'eval')
+    comprehension_codes = [const for const in code.co_consts if hasattr(const, 'co_name')]
+    if comprehension_codes:  # Comprehensions are inlined in Python 3.12+
+        assert code_flags[comprehension_codes[0]] == tracer_module.COMPREHENSION
+
+
+def test_depth_of_recursive_calls():
+    string_io = io.StringIO()
+    config = Config(out=string_io, columns=())
+    tracer = config.snoop(depth=4)
+
+    def recurse(n):
+        if n:
+            return [recurse(m) for m in [n - 1]][0] + 1
+        return 0
+
+    @tracer
+    def foo():
+        return recurse(10)
+
+    assert foo() == 10
+    output = string_io.getvalue()
+    # Comprehensions don't count towards the depth
+    assert output.count(u'<locals>.recurse in File') == 3
+    assert output.count(u'<locals>.recurse: ') == 3
+    assert tracer._frames().frame_distances == {}
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="uses asyncio.get_running_loop")
+def test_coroutines():
+    import inspect
+    from tests import coroutines_sample
+
+    string_io = io.StringIO()
+    config = Config(out=string_io, columns='task')
+    assert inspect.iscoroutinefunction(config.snoop(coroutines_sample.work))
+    # Documented in the README
+    assert not inspect.isasyncgenfunction(config.snoop(coroutines_sample.numbers))
+
+    assert coroutines_sample.main(config.snoop) == (2, [[0], [1]])
+    output = string_io.getvalue()
+    assert output.count(u'>>> Start coroutine work in File') == 1
+    assert output.count(u'>>> Re-enter coroutine work in File') == 2
+    assert output.count(u'>>> Start coroutine helper in File') == 2
+    assert output.count(u'<<< Await in work') == 2
+    assert u'<<< Return value from work: 2' in output
+    assert u'<<< Yield value from numbers: [1]' in output
+    # Awaiting something that finishes raises StopIteration internally
+    assert u'StopIteration' not in output
+    # Other tasks aren't traced while the traced coroutine is waiting
+    assert u'untraced' not in output
+
+    task_names = set(re.findall(r'in task (.+)\n', output))
+    assert len(task_names) == 2
+    for line in output.splitlines():
+        assert line.strip().startswith(tuple(task_names))
+
+
+def test_demux(tmpdir):
+    def run(config):
+        a_started = Event()
+        b_done = Event()
+
+        @config.snoop
+        def a():
+            assert config.last_frame is sys._getframe()
+            a_started.set()
+            b_done.wait()
+            return 'a'
+
+        @config.snoop
+        def b():
+            a_started.wait()
+            return 'b'
+
+        def run_b():
+            b()
+            b_done.set()
+
+        thread = Thread(target=run_b, name='other')
+        thread.start()
+        a()
+        thread.join()
+
+    string_io = io.StringIO()
+    run(Config(out=string_io, columns='thread', demux=True))
+    lines = string_io.getvalue().splitlines()
+    # b finished first, and each call is written in one piece
+    threads = [line.split()[0] for line in lines]
+    assert threads == sorted(threads, key=lambda name: name != 'other')
+    assert threads[0] == 'other' and threads[-1] == 'MainThread'
+    # The line that a was waiting on isn't repeated after b ran in the other thread
+    assert sum(u'b_done.wait()' in line for line in lines) == 1
+
+    path = str(tmpdir.join('snoop-{thread}.log'))
+    run(Config(out=path, columns=(), demux=True))
+    assert u'a_started.wait()' in tmpdir.join('snoop-other.log').read_text('utf8')
+    main_output = tmpdir.join('snoop-MainThread.log').read_text('utf8')
+    assert u'b_done.wait()' in main_output
+    assert u'a_started.wait()' not in main_output
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason="uses task names")
+def test_demux_tasks(tmpdir, monkeypatch):
+    import atexit
+    from tests import coroutines_sample
+
+    registered = []
+    monkeypatch.setattr(atexit, 'register', registered.append)
+    config = Config(out=str(tmpdir.join('{task}.log')), columns=(), demux=True, file_buffer_size=10000)
+    # Only DemuxWriter.flush, not each file
+    assert len(registered) == 1
+
+    assert coroutines_sample.main(config.snoop) == (2, [[0], [1]])
+    assert config.last_frame is None
+    # The writer for the finished gathered task was closed, writing its output
+    assert len(config.demux.file_writers) == 1
+    output = u''.join(path.read_text('utf8') for path in tmpdir.listdir())
+    assert u'<<< Return value from work: 2' in output
+    assert u'numbers' not in output
+
+    registered[0]()
+    output = u''.join(path.read_text('utf8') for path in tmpdir.listdir())
+    assert u'<<< Yield value from numbers: [1]' in output
+    assert len(tmpdir.listdir()) == 2
+
+
+def test_conditional_tracing():
+    string_io = io.StringIO()
+    config = Config(out=string_io, columns=())
+
+    @config.snoop(on_exception=True)
+    def foo(x):
+        y = x * 2
+        if x > 2:
+            raise ValueError(y)
+        return y
+
+    assert foo(1) == 2
+    assert string_io.getvalue() == u''
+    with pytest.raises(ValueError):
+        foo(3)
+    lines = [line.strip() for line in string_io.getvalue().splitlines()]
+    assert lines[0].startswith(u'>>> Call to ')
+    assert u'.............. y = 6' in lines
+    assert lines[-2:] == [u'!!! ValueError: 6', u'!!! Call ended by exception']
+
+    string_io.seek(0)
+    string_io.truncate()
+
+    @config.snoop(only_if='total > 5', buffer_size=3)
+    def bar(n):
+        total = 0
+        for i in range(n):
+            total += i
+        return total
+
+    assert bar(3) == 3
+    assert string_io.getvalue() == u''
+    assert bar(5) == 10
+    lines = [line.strip() for line in string_io.getvalue().splitlines()]
+    # Only the last few events before the condition was met are kept,
+    # then the rest of the call is written normally
+    assert re.match(r'^\.\.\. \d+ earlier events were discarded$', lines[0])
+    assert lines.count(u'.................. total = 6') == 1
+    assert lines[-1].endswith(u'bar: 10')
+    assert len(lines) < 20
+
+    # Calls inside a call traced by another tracer of the same config
+    string_io.seek(0)
+    string_io.truncate()
+
+    @config.snoop(only_if='x > 5')
+    def inner(x):
+        return x
+
+    @config.snoop(on_exception=True)
+    def inner_error(x):
+        if x:
+            raise ValueError(x)
+
+    @config.snoop
+    def outer():
+        inner(10)
+        inner(1)
+        inner(2)
+        inner_error(0)
+        try:
+            inner_error(1)
+        except ValueError:
+            pass
+
+    outer()
+    output = string_io.getvalue()
+    assert u'.inner: 10\n' in output
+    assert u'.inner: 1\n' not in output
+    assert u'x = 2' not in output
+    assert u'.inner_error: None' not in output
+    assert u'!!! ValueError: 1' in output
+
+
+def test_flight_recorder():
+    string_io = io.StringIO()
+    config = Config(out=string_io, columns='thread')
+    recorder = snoop.flight_recorder(size=5, dump_signal=None, dump_on_exception=False, config=config)
+
+    @config.snoop
+    def foo(x):
+        y = x * 2
+        return y
+
+    try:
+        for i in range(10):
+            foo(i)
+        thread = Thread(target=foo, args=(100,), name='other')
+        thread.start()
+        thread.join()
+        assert string_io.getvalue() == u''
+
+        recorder.dump()
+        lines = [line.split(None, 1) for line in string_io.getvalue().splitlines()]
+        assert lines[0] == [u'MainThread', u'=== Last 5 events in thread MainThread']
+        # The oldest event kept is the end of the previous call
+        assert lines[1][1].endswith(u'foo: 16')
+        assert lines[3] == [u'MainThread', u'.......... x = 9']
+        assert lines[8][1].endswith(u'foo: 18')
+        assert lines[9] == [u'other', u'=== Last 4 events in thread other']
+        assert lines[-1][1].endswith(u'foo: 200')
+        assert len(lines) == 17
+
+        # Dumped events are forgotten
+        string_io.seek(0)
+        string_io.truncate()
+        recorder.dump()
+        assert string_io.getvalue() == u''
+    finally:
+        recorder.stop()
+
+    foo(1)
+    assert u'>>> Call to' in string_io.getvalue()
+
+
+def test_flight_recorder_triggers(monkeypatch):
+    import threading
+    from snoop.recorder import dump_thread_name
+
+    hooked = []
+    monkeypatch.setattr(sys, 'excepthook', lambda *args: hooked.append(args[0]))
+    if hasattr(threading, 'excepthook'):
+        monkeypatch.setattr(threading, 'excepthook', lambda args: hooked.append(args.exc_type))
+
+    string_io = io.StringIO()
+    config = Config(out=string_io, columns='thread')
+    recorder = snoop.flight_recorder(size=5, dump_signal=None, config=config)
+
+    @config.snoop
+    def foo(x):
+        if x is None:
+            raise TypeError
+        return x
+
+    def dumped():
+        result = string_io.getvalue()
+        string_io.seek(0)
+        string_io.truncate()
+        return result
+
+    try:
+        foo(1)
+        sys.excepthook(ValueError, ValueError(), None)
+        assert hooked == [ValueError]
+        assert dumped().endswith(u'foo: 1\n')
+
+        if hasattr(threading, 'excepthook'):
+            thread = Thread(target=foo, args=(None,), name='other')
+            thread.start()
+            thread.join()
+            assert hooked == [ValueError, TypeError]
+            assert u'!!! TypeError' in dumped()
+
+        foo(2)
+        recorder._signal_handler(None, None)
+        for thread in threading.enumerate():
+            if thread.name == dump_thread_name:
+                thread.join()
+        assert dumped().endswith(u'foo: 2\n')
+    finally:
+        recorder.stop()
+
+    assert sys.excepthook is not recorder._excepthook
+
+
+def test_cache_limits():
+    config = Config(out=io.StringIO())
+    old_limits = snoop.cache_stats()
+    snoop.set_cache_limit('sources', 10)
+    snoop.set_cache_limit('code_var_ranks', 20)
+    try:
+        for i in range(50):
+            # A different file and code object each time
+            namespace = {}
+            source = 'def foo(x):\n    return x + {}\n'.format(i)
+            exec(compile(source, 'snoop_test_{}.py'.format(i), 'exec'), namespace)
+            config.snoop(namespace['foo'])(i)
+
+        stats = snoop.cache_stats()
+        assert stats['sources']['size'] <= 10
+        assert stats['sources']['evictions'] >= 40
+        assert stats['code_var_ranks']['size'] <= 20
+        assert stats['code_var_ranks']['maxsize'] == 20
+    finally:
+        for name in ('sources', 'code_var_ranks'):
+            snoop.set_cache_limit(name, old_limits[name]['maxsize'])
+
+    # Recently used entries are kept
+    cache = LRUCache('formatters', factory=lambda key: [key])
+    first = cache[0]
+    for i in range(1, 100):
+        assert cache[0] is first
+        assert cache[i] == [i]
+    assert len(cache) <= cache.maxsize
+    assert cache.misses == 100
+    assert cache.pop(99) == [99]
+    assert 99 not in cache
+
+    # Lowering the limit evicts the old generation but keeps the newer one
+    cache = LRUCache('formatters', factory=lambda key: [key])
+    maxsize = cache.maxsize
+    values = [cache[i] for i in range(maxsize)]
+    newer = dict.copy(cache)
+    cache.resize(4)
+    assert len(cache) == len(newer)
+    assert cache.evictions == maxsize - len(newer)
+    assert all(i in cache for i in newer)
+    assert cache[maxsize - 1] is values[-1]
+    assert cache.misses == maxsize
+
+
+@pytest.mark.skipif(PYPY or sys.version_info < (3, 4), reason="uses sys.getallocatedblocks")
+def test_frames_freed_after_trace_errors():
+    import gc
+
+    class WriteError(Exception):
+        pass
+
+    def write(_s):
+        raise WriteError
+
+    # Writing the call fails, so the trace function raises an exception
+    # and Python stops tracing before the 'return' event which forgets the frame
+    config = Config(out=write)
+    tracer = config.snoop(depth=2)
+
+    @tracer
+    def foo(x):
+        return x
+
+    def run(n):
+        for i in range(n):
+            try:
+                foo(i)
+            except WriteError:
+                pass
+            else:
+                assert False
+
+    run(1)
+    frames = tracer._frames()
+    assert not (frames.frame_infos or frames.frame_distances or frames.blocks)
+    assert not tracer.target_frames
+    assert config.thread_local.depth == -1
+
+    run(100)
+    gc.collect()
+    before = sys.getallocatedblocks()
+    run(2000)
+    gc.collect()
+    # Leaking the frames would keep several blocks per call
+    assert sys.getallocatedblocks() - before < 2000
+
+
 def test_needs_parentheses():
     assert not needs_parentheses('x')
     assert not needs_parentheses('x.y')